@@ -3,8 +3,6 @@ import logging
 import urllib.parse
 from typing import Any, Optional
 
-import requests
-
 from exceptions import InvalidAPIResponseException
 from support import valid, valid_response
 
@@ -13,11 +11,12 @@ MAXSIZE = 1000
 
 
 class API:
+    # Every response is logged here, where it goes is up to the caller's logging setup.
     logger = logging.getLogger("requests")
-    logging.basicConfig(filename="requests.log", level=logging.INFO)
 
     def __init__(self, api_key: str) -> None:
         self.API_KEY = api_key
+        self._session: Any = None
         self.headers = {
             "User-Agent": "lastfm-to-sqlite",
             "Accept": "application/json",
@@ -26,9 +25,23 @@ class API:
             "Connection": "keep-alive",
         }
 
+    def fork(self) -> "API":
+        # Same key, own session. `requests.Session` isn't thread-safe, so each thread needs one.
+        return API(self.API_KEY)
+
+    @property
+    def session(self) -> Any:
+        # `requests` is only imported once the first request goes out.
+        if self._session is None:
+            import requests
+
+            self._session = requests.Session()
+            self._session.headers.update(self.headers)
+        return self._session
+
     def get_resource(self, URL: str) -> Any:
         print(f"Fetching : {URL.split('method=')[1]}")
-        r = requests.get(URL, headers=self.headers)
+        r = self.session.get(URL)
 
         if r.status_code == 200:
             data = r.content.decode()
@@ -40,7 +53,12 @@ class API:
             )
 
     def get_scrobble_data(
-        self, user: str, page: int, maxsize: int = 10, extended_info: int = 1
+        self,
+        user: str,
+        page: int,
+        maxsize: int = 10,
+        extended_info: int = 1,
+        from_uts: Optional[int] = None,
     ):
         _format = "json"
         _method = "user.getRecentTracks"
@@ -50,6 +68,21 @@ class API:
             f"{HOST_NAME}?api_key={self.API_KEY}&format={_format}&method={_method}&limit={maxsize}&user={user}"
             f"&page={page}&extended={extended_info}"
         )
+        if from_uts is not None:  # Only scrobbles after this unix timestamp.
+            URL += f"&from={from_uts}"
+
+        return self.get_resource(URL)
+
+    def get_loved_tracks(self, user: str, page: int, maxsize: int = MAXSIZE):
+        # Loved tracks, most recently loved first.
+        _format = "json"
+        _method = "user.getLovedTracks"
+        user = urllib.parse.quote(user)
+
+        URL = (
+            f"{HOST_NAME}?api_key={self.API_KEY}&format={_format}&method={_method}&limit={maxsize}&user={user}"
+            f"&page={page}"
+        )
 
         return self.get_resource(URL)
 
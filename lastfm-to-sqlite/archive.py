@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import stat
+from datetime import datetime
+
+from sqlite_utils import Database
+
+from sql_helpers import (
+    ARCHIVED_PLAYS_SUMMARY,
+    SCROBBLE_COLUMNS,
+    TAG_AGGREGATE_TRIGGERS,
+    Datastore,
+    DataLayer,
+)
+
+# Same columns as the live scrobbles table. Foreign keys can't point across databases.
+ARCHIVE_SCHEMA = [
+    """
+    create table if not exists [{schema}].[scrobbles] (
+        [id] TEXT PRIMARY KEY,
+        [album_id] TEXT NOT NULL,
+        [track_id] TEXT NOT NULL,
+        [artist_id] TEXT NOT NULL,
+        [timestamp] TEXT NOT NULL,
+        [user] TEXT NOT NULL DEFAULT '',
+        [uts] INTEGER
+    )
+    """,
+    "create unique index if not exists [{schema}].idx_scrobbles_natural_key on scrobbles (user, uts, track_id)",
+    "create index if not exists [{schema}].idx_scrobbles_timestamp on scrobbles (timestamp)",
+]
+
+
+class Archiver:
+    """
+    Rolls closed years of scrobbles out of the live db into per year database files,
+    `<archive_dir>/scrobbles-<year>.db`, registered in the `archive_partitions` table.
+    Archived files are vacuumed and made read-only. `DataLayer.scrobbles_view` unions them
+    back with the live table, attaching only the partitions a time range needs, and
+    `DataLayer.each_partition` reads them one at a time.
+    Only scrobbles are archived, entities, stats and tags stay in the live db.
+    Their play counts stay too, in archived_plays, so the tag aggregates keep counting
+    archived scrobbles, including when tags are mapped or removed later.
+    """
+
+    def __init__(self, db: Database, archive_dir: str) -> None:
+        self.db = db
+        self.archive_dir = archive_dir
+        self.datalayer = DataLayer(db)
+
+    def closed_years(self) -> list[int]:
+        # Years, before the current one, that still have scrobbles in the live db.
+        this_year = datetime.now().year
+        cursor = self.db.execute(
+            "select distinct substr(timestamp, 1, 4) from scrobbles where timestamp < ?",
+            [f"{this_year}-01-01T00:00:00"],
+        )
+        years = sorted(int(row[0]) for row in cursor.fetchall())
+        cursor.close()
+        return years
+
+    def archive_closed_years(self) -> dict[int, int]:
+        # Archives every closed year, returns the number of scrobbles moved per year.
+        moved = {year: self.archive_year(year) for year in self.closed_years()}
+        if moved:
+            Datastore(self.db).vacuum()
+        return moved
+
+    def archive_year(self, year: int) -> int:
+        """
+        Moves the year's scrobbles into its partition, creating it if needed, or appending to it
+        if late scrobbles for that year came in after it was archived.
+        Returns the number of scrobbles moved.
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        name = str(year)
+        schema = f"archive_{name}"
+        path = os.path.abspath(os.path.join(self.archive_dir, f"scrobbles-{name}.db"))
+        start, end = f"{year}-01-01T00:00:00", f"{year + 1}-01-01T00:00:00"
+
+        if schema in self.datalayer.attached_databases():
+            self.db.execute(f"detach database [{schema}]")
+        if os.path.exists(path):
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+
+        self.db.execute(f"attach database ? as [{schema}]", [path])
+        conn = self.db.conn
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("begin immediate")
+        try:
+            for statement in ARCHIVE_SCHEMA:
+                conn.execute(statement.format(schema=schema))
+            # Live rows already in the partition are duplicates, not moves. They go through the
+            # delete trigger, so their second count comes off the tag aggregates.
+            conn.execute(
+                f"""
+                delete from main.scrobbles
+                where timestamp >= ? and timestamp < ? and exists (
+                    select 1 from [{schema}].scrobbles as archived
+                    where archived.user = scrobbles.user
+                    and archived.uts = scrobbles.uts
+                    and archived.track_id = scrobbles.track_id
+                )
+                """,
+                [start, end],
+            )
+            conn.execute(
+                f"""
+                insert or ignore into [{schema}].scrobbles ({SCROBBLE_COLUMNS})
+                select {SCROBBLE_COLUMNS} from main.scrobbles
+                where timestamp >= ? and timestamp < ?
+                """,
+                [start, end],
+            )
+            conn.execute(
+                ARCHIVED_PLAYS_SUMMARY.format(
+                    target="archived_plays",
+                    scrobbles="main.scrobbles",
+                    where="timestamp >= ? and timestamp < ?",
+                ),
+                [start, end] * 3,
+            )
+            # Archived scrobbles still count towards the tag aggregates, so they must
+            # leave the live table without going through the delete trigger.
+            conn.execute("drop trigger scrobbles_after_delete")
+            moved = conn.execute(
+                "delete from main.scrobbles where timestamp >= ? and timestamp < ?",
+                [start, end],
+            ).rowcount
+            conn.execute(TAG_AGGREGATE_TRIGGERS["scrobbles_after_delete"])
+            row_count = conn.execute(f"select count(*) from [{schema}].scrobbles").fetchone()[0]
+            conn.execute(
+                """
+                insert or replace into archive_partitions
+                (name, path, start_timestamp, end_timestamp, row_count)
+                values (?, ?, ?, ?, ?)
+                """,
+                [name, path, start, end, row_count],
+            )
+            conn.execute("commit")
+        except BaseException:
+            conn.execute("rollback")
+            raise
+        finally:
+            self.db.execute(f"detach database [{schema}]")
+
+        self.seal(path)
+        return moved
+
+    @staticmethod
+    def seal(path: str) -> None:
+        # Compacts the partition file and makes it read-only.
+        partition = sqlite3.connect(path)
+        try:
+            partition.execute("vacuum")
+        finally:
+            partition.close()
+        os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
@@ -0,0 +1,241 @@
+"""
+Command line entry point, eg : `python lastfm-to-sqlite/cli.py sync lastfm.db --user <username>`.
+
+Nothing heavy is imported at module level. Each subcommand imports what it needs when it runs,
+so short invocations (eg : `stats` from a cron job) only pay for argparse and sqlite3.
+"""
+import argparse
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+API_KEY_ENV = "LASTFM_API_KEY"
+
+
+class Profile:
+    # Wall clock time per phase of a run, printed to stderr with `--profile`.
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self.timings: list[tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.perf_counter() - start))
+
+    def report(self, started: float) -> None:
+        if not self.enabled:
+            return
+        total = time.perf_counter() - started
+        width = max(len(name) for name, _ in self.timings + [("total", 0)])
+        for name, seconds in self.timings + [("total", total)]:
+            print(f"{name:<{width}} : {seconds * 1000:9.1f} ms", file=sys.stderr)
+
+
+def open_db(path: str, profile: Profile) -> Any:
+    # Opens (and migrates) the sqlite-utils database.
+    with profile.phase("import sqlite_utils"):
+        from sqlite_utils import Database
+
+        from sql_helpers import Datastore
+    with profile.phase("open db"):
+        db = Database(path)
+        Datastore(db).create_tables()
+    return db
+
+
+def open_api(args: argparse.Namespace, profile: Profile) -> Any:
+    api_key = args.api_key or os.environ.get(API_KEY_ENV)
+    if not api_key:
+        raise SystemExit(f"An API key is needed, pass --api-key or set {API_KEY_ENV}.")
+    with profile.phase("import api"):
+        import logging
+
+        from api import API
+
+    if args.log:
+        logging.basicConfig(filename=args.log, level=logging.INFO)
+    return API(api_key)
+
+
+def latest_uts(db: Any, user: str) -> Optional[int]:
+    # The user's latest scrobble, from the live table, or from the newest archive holding any
+    # of their scrobbles when the live table has none. Scrobbles from before the user column
+    # (user = '') count as theirs, `ScrobblePipeline.run` hands them over to the user.
+    from sql_helpers import DataLayer
+
+    datalayer = DataLayer(db)
+    query = """
+        select max(uts) from (
+            select max(uts) as uts from [{schema}].scrobbles where user = ?
+            union all select max(uts) from [{schema}].scrobbles where user = ''
+        )
+    """
+    uts = db.execute(query.format(schema="main"), [user]).fetchone()[0]
+    for partition in reversed(datalayer.partitions()):
+        if uts is not None:
+            break
+        with datalayer.attached([partition]) as (schema,):
+            cursor = db.execute(query.format(schema=schema), [user])
+            uts = cursor.fetchone()[0]
+            cursor.close()
+    return uts
+
+
+def sync(args: argparse.Namespace, profile: Profile) -> None:
+    # Fetches the scrobbles newer than the latest one in the db.
+    api = open_api(args, profile)
+    db = open_db(args.db, profile)
+    with profile.phase("import pipeline"):
+        from pipeline import ScrobblePipeline
+
+    with profile.phase("sync"):
+        from_uts = latest_uts(db, args.user)
+        count = ScrobblePipeline(db, api, args.user).run(from_uts=from_uts)
+    print(f"Saved {count} new scrobbles.")
+
+
+def backfill(args: argparse.Namespace, profile: Profile) -> None:
+    # Fetches a range of pages, the whole history by default.
+    api = open_api(args, profile)
+    db = open_db(args.db, profile)
+    with profile.phase("import pipeline"):
+        from pipeline import ScrobblePipeline
+
+    with profile.phase("backfill"):
+        count = ScrobblePipeline(db, api, args.user).run(
+            start_page=args.start_page, end_page=args.end_page
+        )
+    print(f"Saved {count} new scrobbles.")
+
+
+def enrich(args: argparse.Namespace, profile: Profile) -> None:
+    # Links similar artists, and syncs the user's loved tracks.
+    api = open_api(args, profile)
+    db = open_db(args.db, profile)
+    with profile.phase("import parse"):
+        from parse import LovedTracks
+        from sql_helpers import DataLayer
+
+    with profile.phase("similar artists"):
+        pairs = DataLayer(db).resolve_similar_artists()
+    with profile.phase("loved tracks"):
+        loved = LovedTracks(db, api, args.user).sync(full=args.full)
+    print(f"Linked {pairs} similar artist pairs, synced {loved} loved tracks.")
+
+
+def stats(args: argparse.Namespace, profile: Profile) -> None:
+    # Plain sqlite3, so status checks don't pay for sqlite-utils.
+    import sqlite3
+
+    with profile.phase("stats"):
+        if not os.path.exists(args.db):
+            raise SystemExit(f"No database at {args.db}.")
+        conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+        try:
+            print(f"schema version : {conn.execute('pragma user_version').fetchone()[0]}")
+            tables = {
+                row[0]
+                for row in conn.execute("select name from sqlite_master where type = 'table'")
+            }
+            for table in ["scrobbles", "artists", "albums", "tracks", "tags"]:
+                if table in tables:
+                    count = conn.execute(f"select count(*) from [{table}]").fetchone()[0]
+                    print(f"{table:<14} : {count}")
+            if "scrobbles" in tables:
+                last = conn.execute("select max(timestamp) from scrobbles").fetchone()[0]
+                print(f"last scrobble  : {last}")
+        finally:
+            conn.close()
+
+
+def export(args: argparse.Namespace, profile: Profile) -> None:
+    db = open_db(args.db, profile)
+    with profile.phase("import export"):
+        from export import HistoryExporter
+
+    with profile.phase("export"):
+        count = HistoryExporter(db, args.out_dir, file_format=args.format).export()
+    print(f"Exported {count} scrobbles.")
+
+
+def compact(args: argparse.Namespace, profile: Profile) -> None:
+    db = open_db(args.db, profile)
+    from sql_helpers import Datastore
+
+    with profile.phase("compact"):
+        deleted = Datastore(db).compact()
+    for table, count in deleted.items():
+        print(f"{table:<20} : {count} rows deleted")
+
+
+def archive(args: argparse.Namespace, profile: Profile) -> None:
+    db = open_db(args.db, profile)
+    with profile.phase("import archive"):
+        from archive import Archiver
+
+    with profile.phase("archive"):
+        moved = Archiver(db, args.archive_dir).archive_closed_years()
+    for year, count in moved.items():
+        print(f"{year} : {count} scrobbles archived")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="lastfm-to-sqlite", description="Save last.fm listening history to sqlite."
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="Print a timing breakdown to stderr."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name: str, handler: Any, help: str, api: bool = False) -> Any:
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.set_defaults(handler=handler)
+        subparser.add_argument("db", help="Path to the sqlite database.")
+        if api:
+            subparser.add_argument("--user", required=True, help="last.fm username.")
+            subparser.add_argument("--api-key", help=f"last.fm API key, defaults to ${API_KEY_ENV}.")
+            subparser.add_argument(
+                "--log", default="requests.log", help="File API responses are logged to, '' to disable."
+            )
+        return subparser
+
+    add_command("sync", sync, "Fetch scrobbles newer than the latest saved one.", api=True)
+    subparser = add_command("backfill", backfill, "Fetch a range of history pages.", api=True)
+    subparser.add_argument("--start-page", type=int, default=1)
+    subparser.add_argument("--end-page", type=int, default=None)
+    subparser = add_command(
+        "enrich", enrich, "Link similar artists and sync loved tracks.", api=True
+    )
+    subparser.add_argument(
+        "--full", action="store_true", help="Re-sync the whole loved set, picks up unloves."
+    )
+    add_command("stats", stats, "Print row counts and the latest scrobble.")
+    subparser = add_command("export", export, "Export the history to Parquet / Arrow files.")
+    subparser.add_argument("out_dir")
+    subparser.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+    add_command("compact", compact, "Remove duplicate and orphan rows, then vacuum.")
+    subparser = add_command("archive", archive, "Move closed years of scrobbles to archives.")
+    subparser.add_argument("archive_dir")
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    started = time.perf_counter()
+    args = build_parser().parse_args(argv)
+    profile = Profile(args.profile)
+    try:
+        args.handler(args, profile)
+    finally:
+        profile.report(started)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,7 @@
 from typing import Optional, TypedDict
 
+from support import dict_fetch, safe_int
+
 
 class Tag(TypedDict):
     name: str
@@ -80,3 +82,60 @@ class ScrobbleRow(TypedDict):
     album_id: str
     track_id: str
     timestamp: str
+    user: str
+    uts: int
+
+
+class ScrobbleRecord:
+    # Compact, flat form of a `Scrobble` payload, for holding many in memory at once.
+    __slots__ = (
+        "artist_name",
+        "artist_mbid",
+        "album_name",
+        "album_mbid",
+        "track_name",
+        "track_mbid",
+        "is_loved",
+        "uts",
+    )
+
+    def __init__(
+        self,
+        artist_name: str,
+        artist_mbid: str,
+        album_name: str,
+        album_mbid: str,
+        track_name: str,
+        track_mbid: str,
+        is_loved: int,
+        uts: int,
+    ) -> None:
+        self.artist_name = artist_name
+        self.artist_mbid = artist_mbid
+        self.album_name = album_name
+        self.album_mbid = album_mbid
+        self.track_name = track_name
+        self.track_mbid = track_mbid
+        self.is_loved = is_loved
+        self.uts = uts
+
+    @classmethod
+    def from_scrobble(cls, scrobble: Scrobble) -> Optional["ScrobbleRecord"]:
+        # Returns None for the "now playing" entry, which has no date yet.
+        uts = dict_fetch(scrobble, "date", "uts")
+        if not uts:
+            return None
+        return cls(
+            # With extended info the names are under "name", otherwise under "#text".
+            # If both are valid, "name" takes precedence.
+            artist_name=dict_fetch(scrobble, "artist", "name")
+            or dict_fetch(scrobble, "artist", "#text"),
+            artist_mbid=dict_fetch(scrobble, "artist", "mbid"),
+            album_name=dict_fetch(scrobble, "album", "name")
+            or dict_fetch(scrobble, "album", "#text"),
+            album_mbid=dict_fetch(scrobble, "album", "mbid"),
+            track_name=dict_fetch(scrobble, "name"),
+            track_mbid=dict_fetch(scrobble, "mbid"),
+            is_loved=safe_int(dict_fetch(scrobble, "loved")),
+            uts=int(uts),
+        )
@@ -0,0 +1,213 @@
+import json
+import os
+import shutil
+from typing import Iterator
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from sqlite_utils import Database
+
+from sql_helpers import DataLayer
+
+BATCH_SIZE = 50_000
+MANIFEST_FILE = "_manifest.json"
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# One row per scrobble, with the track, artist and album it points to flattened in.
+# Track tags are folded into a single comma separated column.
+# `{scrobbles}` is the live table, or a view unioning it with the archive partitions.
+HISTORY_QUERY = """
+select
+    scrobbles.id as scrobble_id,
+    scrobbles.timestamp as timestamp,
+    scrobbles.user as user,
+    scrobbles.uts as uts,
+    tracks.name as track_name,
+    tracks.url as track_url,
+    tracks.mbid as track_mbid,
+    cast(tracks.duration as integer) as track_duration,
+    artists.name as artist_name,
+    artists.url as artist_url,
+    artists.mbid as artist_mbid,
+    albums.name as album_name,
+    albums.url as album_url,
+    albums.mbid as album_mbid,
+    (
+        select group_concat(tags.name, ',')
+        from tag_mappings
+        join tags on tags.id = tag_mappings.tag_id
+        where tag_mappings.media_id = scrobbles.track_id
+    ) as track_tags
+from {scrobbles} as scrobbles
+left join tracks on tracks.id = scrobbles.track_id
+left join artists on artists.id = scrobbles.artist_id
+left join albums on albums.id = scrobbles.album_id
+where scrobbles.timestamp >= ? and scrobbles.timestamp < ?
+order by scrobbles.timestamp
+"""
+
+HISTORY_SCHEMA = pa.schema(
+    [
+        ("scrobble_id", pa.string()),
+        ("timestamp", pa.string()),
+        ("user", pa.string()),
+        ("uts", pa.int64()),
+        ("track_name", pa.string()),
+        ("track_url", pa.string()),
+        ("track_mbid", pa.string()),
+        ("track_duration", pa.int64()),
+        ("artist_name", pa.string()),
+        ("artist_url", pa.string()),
+        ("artist_mbid", pa.string()),
+        ("album_name", pa.string()),
+        ("album_url", pa.string()),
+        ("album_mbid", pa.string()),
+        ("track_tags", pa.string()),
+    ]
+)
+
+
+class HistoryExporter:
+    """
+    Streams the denormalized scrobble history, live and archived, into a directory of Parquet
+    (or Arrow IPC) files, one per month, eg : `out_dir/month=2023-05/part-0.parquet`.
+    Rows are pulled from sqlite in batches of `batch_size`, so memory stays bounded.
+    Exports are incremental. `out_dir/_manifest.json` keeps a (row count, sum of uts)
+    fingerprint per exported month, and a repeated export only rewrites the months whose
+    fingerprint changed. That covers new months, the current month growing, and scrobbles
+    backfilled into older months. The manifest also records the exported columns, a change
+    of columns rewrites every month.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        out_dir: str,
+        file_format: str = "parquet",
+        batch_size: int = BATCH_SIZE,
+    ) -> None:
+        if file_format not in FORMATS:
+            raise ValueError(
+                f"Unsupported export format : {file_format}, expected one of {list(FORMATS)}."
+            )
+        self.db = db
+        self.out_dir = out_dir
+        self.file_format = file_format
+        self.batch_size = batch_size
+        self.datalayer = DataLayer(db)
+
+    def read_manifest(self) -> dict[str, list[int]]:
+        # Month -> [row count, sum of uts] as of the last export of that month.
+        path = os.path.join(self.out_dir, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            manifest = json.load(f)
+        months = manifest["months"] if "columns" in manifest else manifest
+        if manifest.get("columns") != HISTORY_SCHEMA.names:
+            # Exported with other columns, every month is stale.
+            return {month: [] for month in months}
+        return months
+
+    def write_manifest(self, months: dict[str, list[int]]) -> None:
+        path = os.path.join(self.out_dir, MANIFEST_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(
+                {"columns": HISTORY_SCHEMA.names, "months": months}, f, indent=1, sort_keys=True
+            )
+        os.replace(path + ".tmp", path)
+
+    def month_fingerprints(self) -> dict[str, list[int]]:
+        # Read from the live table, then from each partition in turn.
+        fingerprints: dict[str, list[int]] = {}
+
+        def add(schema: str) -> None:
+            cursor = self.db.execute(
+                f"""
+                select substr(timestamp, 1, 7), count(*), total(uts)
+                from [{schema}].scrobbles
+                group by substr(timestamp, 1, 7)
+                """
+            )
+            for month, count, uts in cursor.fetchall():
+                fingerprint = fingerprints.setdefault(month, [0, 0])
+                fingerprint[0] += count
+                fingerprint[1] += int(uts)
+            cursor.close()
+
+        add("main")
+        for schema in self.datalayer.each_partition():
+            add(schema)
+        return fingerprints
+
+    def iter_batches(self, month: str) -> Iterator[pa.RecordBatch]:
+        # Yields record batches, ordered by timestamp, of all scrobbles of `month` (YYYY-MM).
+        year, number = int(month[:4]), int(month[5:7])
+        start = f"{month}-01T00:00:00"
+        end = f"{year + number // 12:04d}-{number % 12 + 1:02d}-01T00:00:00"
+        names = HISTORY_SCHEMA.names
+        with self.datalayer.scrobbles_view(start, end) as scrobbles:
+            cursor = self.db.execute(HISTORY_QUERY.format(scrobbles=scrobbles), [start, end])
+            try:
+                while rows := cursor.fetchmany(self.batch_size):
+                    columns = [list(column) for column in zip(*rows)]
+                    yield pa.RecordBatch.from_arrays(
+                        [pa.array(c, type=t) for c, t in zip(columns, HISTORY_SCHEMA.types)],
+                        names=names,
+                    )
+            finally:
+                cursor.close()
+
+    def export(self) -> int:
+        """
+        Rewrites every month that changed since the last export, and returns the number of
+        rows written. Each month is written under a temporary name and swapped in whole, and the
+        manifest is updated after every month, so an interrupted export resumes where it stopped.
+        """
+        os.makedirs(self.out_dir, exist_ok=True)
+        manifest = self.read_manifest()
+        fingerprints = self.month_fingerprints()
+        written = 0
+        for month, fingerprint in sorted(fingerprints.items()):
+            if manifest.get(month) == fingerprint:
+                continue
+            written += self.export_month(month)
+            manifest[month] = fingerprint
+            self.write_manifest(manifest)
+
+        # Months with no scrobbles left, eg : after `Datastore.compact`.
+        for month in set(manifest) - set(fingerprints):
+            shutil.rmtree(os.path.join(self.out_dir, f"month={month}"), ignore_errors=True)
+            del manifest[month]
+            self.write_manifest(manifest)
+        return written
+
+    def export_month(self, month: str) -> int:
+        directory = os.path.join(self.out_dir, f"month={month}")
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, f".part-{os.getpid()}.tmp")
+        if self.file_format == "parquet":
+            writer = pq.ParquetWriter(tmp_path, HISTORY_SCHEMA)
+            write = writer.write_batch
+        else:
+            writer = ipc.new_file(tmp_path, HISTORY_SCHEMA)
+            write = writer.write
+
+        written = 0
+        try:
+            for batch in self.iter_batches(month):
+                write(batch)
+                written += batch.num_rows
+            writer.close()
+        except BaseException:
+            writer.close()
+            os.remove(tmp_path)
+            raise
+
+        # Drop the month's previous parts, then swap the new one in.
+        for name in os.listdir(directory):
+            if name.startswith("part-"):
+                os.remove(os.path.join(directory, name))
+        os.replace(tmp_path, os.path.join(directory, f"part-0{FORMATS[self.file_format]}"))
+        return written
@@ -1,14 +1,13 @@
 from datetime import datetime, timedelta
-from sqlite3 import IntegrityError
-from typing import Any
+from typing import Any, Optional
 
 from sqlite_utils import Database
 
 from api import API
-from dataclass import Artist, StatsRow, Track, Album, Scrobble
+from dataclass import Artist, StatsRow, Track, Album, Scrobble, ScrobbleRecord, ScrobbleRow
 from exceptions import InvalidAPIResponseException
-from sql_helpers import DataLayer
-from support import dict_fetch, valid, valid_response, safe_int
+from sql_helpers import DataLayer, TagInterner
+from support import dict_fetch, valid, valid_response
 
 
 class Artists:
@@ -280,56 +279,159 @@ class Albums:
 
 
 class Scrobbles:
-    def __init__(self, db: Database, api: API):
+    def __init__(self, db: Database, api: API, user: str = ""):
         self.db = db
         self.api = api
+        self.user = user
         self.datalayer = DataLayer(self.db)
+        self.artists = Artists(self.db, self.api)
+        self.albums = Albums(self.db, self.api)
+        self.tracks = Tracks(self.db, self.api)
 
     def handle_scrobble(self, scrobble: Scrobble) -> None:
-        artist = Artists(self.db, self.api)
-        album = Albums(self.db, self.api)
-        track = Tracks(self.db, self.api)
-
-        artist_name, artist_url, artist_mbid = (
-            (dict_fetch(scrobble, "artist", "name") or dict_fetch(scrobble, "artist", "#text")),
-            # In this case, if the first entry is not valid, it would take the second entry.
-            # But if both are valid, the first one takes precedence.
-            dict_fetch(scrobble, "artist", "url"),
-            dict_fetch(scrobble, "artist", "mbid"),
-        )
-        album_name, album_mbid = (
-                    dict_fetch(scrobble, "album", "name") or dict_fetch(scrobble, "album", "#text")), dict_fetch(
-            scrobble, "album", "mbid"
-        )
-        track_name, track_url, track_mbid = (
-            dict_fetch(scrobble, "name"),
-            dict_fetch(scrobble, "url"),
-            dict_fetch(scrobble, "mbid"),
-        )
-        track_is_loved = safe_int(dict_fetch(scrobble, "loved"))
-        timestamp = Commons().isotimestamp_from_unixtimestamp(scrobble["date"]["uts"])
+        record = ScrobbleRecord.from_scrobble(scrobble)
+        if record is None:
+            return
+        scrobble_row = self.resolve(record)
+        if scrobble_row is None:
+            return
 
+        # (user, uts, track_id) is unique, so overlapping page fetches are no-ops.
+        # The index only covers the live table, archived scrobbles are checked separately.
+        if self.datalayer.unarchived([scrobble_row]):
+            self.db["scrobbles"].insert(scrobble_row, hash_id="id", ignore=True)
+
+    def resolve(self, record: ScrobbleRecord) -> Optional[ScrobbleRow]:
+        """
+        Resolves (or fetches and creates) the artist, album and track of the scrobble,
+        and returns the row to be written to the scrobbles table.
+        Returns None if the API returned invalid data for any of them.
+        """
         try:
-            artist_id = artist.get_or_create_artist_id(artist_name, artist_mbid)
-            album_id = album.get_or_create_album_id(artist_name, album_name, album_mbid)
-            track_id = track.get_or_create_track_id(
-                artist_name,
-                track_name,
-                track_mbid,
-                track_is_loved,
+            artist_id = self.artists.get_or_create_artist_id(
+                record.artist_name, record.artist_mbid
+            )
+            album_id = self.albums.get_or_create_album_id(
+                record.artist_name, record.album_name, record.album_mbid
+            )
+            track_id = self.tracks.get_or_create_track_id(
+                record.artist_name,
+                record.track_name,
+                record.track_mbid,
+                record.is_loved,
             )
         except InvalidAPIResponseException as E:
             print(E)
-            return
+            return None
 
-        scrobble_row = {
+        return {
             "album_id": album_id,
             "track_id": track_id,
             "artist_id": artist_id,
-            "timestamp": timestamp,
+            "timestamp": Commons().isotimestamp_from_unixtimestamp(str(record.uts)),
+            "user": self.user,
+            "uts": record.uts,
         }
 
-        self.db["scrobbles"].insert(scrobble_row, hash_id="id")
+
+class LovedTracks:
+    """
+    Syncs a user's loved tracks through user.getLovedTracks, a page of up to 1000 tracks per
+    request, into the loved_tracks table, and from there onto the tracks' stats rows.
+    Incremental syncs only fetch tracks loved since the last sync, so they can't see unloves,
+    a full sync replaces the user's whole loved set.
+    """
+
+    def __init__(self, db: Database, api: API, user: str):
+        self.db = db
+        self.api = api
+        self.user = user
+
+    def last_loved_uts(self) -> int:
+        cursor = self.db.execute(
+            "select max(uts) from loved_tracks where user = ?", [self.user]
+        )
+        result = cursor.fetchone()[0]
+        cursor.close()
+        return result or 0
+
+    def fetch(self, since_uts: int = 0) -> list[dict[str, Any]]:
+        # Loved tracks rows, of tracks loved after `since_uts`.
+        rows = []
+        page = 1
+        while True:
+            data = self.api.get_loved_tracks(self.user, page)
+            if not valid_response(data):
+                raise InvalidAPIResponseException("API returned invalid data.")
+            tracks = dict_fetch(data, "lovedtracks", "track") or []
+            if type(tracks) == dict:  # Single track on this page, so we can't iterate
+                tracks = [tracks]  # Now we can iterate as usual
+            for track in tracks:
+                uts = int(dict_fetch(track, "date", "uts") or 0)
+                if not uts:  # Undated, can't be placed against `since_uts`.
+                    continue
+                # Pages are ordered most recently loved first. Tracks loved in the same second
+                # as the last sync are read again, in case that sync only saw some of them.
+                if since_uts and uts < since_uts:
+                    return rows
+                rows.append(
+                    {
+                        "user": self.user,
+                        "artist_name": dict_fetch(track, "artist", "name"),
+                        "track_name": dict_fetch(track, "name"),
+                        "mbid": dict_fetch(track, "mbid"),
+                        "uts": uts,
+                    }
+                )
+            total_pages = int(dict_fetch(data, "lovedtracks", "@attr", "totalPages") or 0)
+            if page >= total_pages:
+                return rows
+            page += 1
+
+    def sync(self, full: bool = False) -> int:
+        # Returns the number of loved tracks fetched.
+        rows = self.fetch(0 if full else self.last_loved_uts())
+        with self.db.conn:
+            if full:
+                self.db.execute("delete from loved_tracks where user = ?", [self.user])
+            self.db["loved_tracks"].insert_all(rows, replace=True)  # type: ignore
+        self.apply()
+        return len(rows)
+
+    def apply(self) -> None:
+        """
+        Matches loved tracks to tracks, on track and artist name, falling back to mbid,
+        then sets `is_loved` on every track's stats rows from the loved set, in one update.
+        """
+        with self.db.conn:
+            self.db.execute(
+                """
+                update loved_tracks set track_id = coalesce(
+                    (
+                        select tracks.id from tracks
+                        join artists on artists.id = tracks.artist_id
+                        where tracks.name = loved_tracks.track_name
+                        and artists.name = loved_tracks.artist_name
+                    ),
+                    (
+                        select tracks.id from tracks
+                        where loved_tracks.mbid != '' and tracks.mbid = loved_tracks.mbid
+                    )
+                )
+                where track_id is null
+                """
+            )
+            self.db.execute(
+                """
+                update stats set is_loved = exists (
+                    select 1 from loved_tracks where loved_tracks.track_id = stats.media_id
+                )
+                where media_id in (select id from tracks)
+                and is_loved is not exists (
+                    select 1 from loved_tracks where loved_tracks.track_id = stats.media_id
+                )
+                """
+            )
 
 
 class Commons:
@@ -353,24 +455,17 @@ class Commons:
         db: Database, tags: list[dict[str, str]], media_id: str
     ) -> None:
         """
-        Try to add tag into table, get PK, or if it exists, just get PK.
+        Resolve the tag's PK through the db's `TagInterner`, adding the tag if it's new.
         Then add media_id to tag_id mapping based on the 2nd param.
         """
-        datalayer = DataLayer(db)
+        interner = TagInterner.for_db(db)
         if not valid(tags):
             print(f"SOFT ERROR : Invalid data received, tags : {tags}")
             return
         if type(tags) == dict:  # Single tag on this media, so we can't iterate
             tags = [tags]  # Now we can iterate as usual
         for tag in tags:
-            try:  # Try to insert row to get PK.
-                tag_id = db["tags"].insert(tag, hash_id="id").last_pk
-            except IntegrityError:  # Except if it already exists, just get PK.
-                search_result = datalayer.search_on_table(
-                    "tags", "name", tag["name"], "id"
-                )
-                tag_id: str = search_result
-
+            tag_id = interner.get_or_create_tag_id(tag)
             tag_mapping_row = {"media_id": media_id, "tag_id": tag_id}
 
             db["tag_mappings"].insert(tag_mapping_row, hash_id="id", ignore=True)
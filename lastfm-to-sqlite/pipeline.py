@@ -0,0 +1,184 @@
+import threading
+from queue import Empty, Full, Queue
+from typing import Any, Iterator, Optional
+
+from sqlite_utils import Database
+from sqlite_utils.utils import hash_record
+
+from api import API
+from dataclass import ScrobbleRecord, ScrobbleRow
+from parse import Scrobbles
+from sql_helpers import SCROBBLE_COLUMNS, Datastore
+from support import dict_fetch, safe_int
+
+PAGE_SIZE = 200  # Largest page user.getRecentTracks serves.
+QUEUE_SIZE = 4  # Pages in flight between two stages.
+BATCH_SIZE = 500  # Scrobble rows per write transaction.
+_DONE = object()  # Marks the end of a stage's output.
+
+
+class ScrobblePipeline:
+    """
+    Ingests a user's scrobble history as 4 overlapping stages :
+        fetch     : (thread) pulls pages of user.getRecentTracks.
+        normalize : (thread) turns each page into compact `ScrobbleRecord`s.
+        resolve   : resolves artist / album / track ids, fetching unknown ones.
+        write     : writes scrobble rows in batches, one transaction per batch.
+    Stages are joined by bounded queues, so a slow stage holds the others back
+    and memory stays flat however long the history is.
+    resolve and write run on the calling thread, since they share the sqlite connection.
+    fetch gets its own `API` (and so its own http session), resolve uses `api`.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        api: API,
+        user: str,
+        page_size: int = PAGE_SIZE,
+        queue_size: int = QUEUE_SIZE,
+        batch_size: int = BATCH_SIZE,
+    ) -> None:
+        self.db = db
+        self.api = api
+        self.fetch_api = api.fork()
+        self.user = user
+        self.page_size = page_size
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.scrobbles = Scrobbles(db, api, user)
+        self.stop = threading.Event()
+        self.errors: list[BaseException] = []
+
+    def run(
+        self, start_page: int = 1, end_page: Optional[int] = None, from_uts: Optional[int] = None
+    ) -> int:
+        """
+        Ingests pages [start_page, end_page] (all remaining pages if end_page is None),
+        optionally only of scrobbles after `from_uts`. Returns the number of new scrobbles written.
+        """
+        Datastore(self.db).claim_scrobbles(self.user)
+        pages: Queue = Queue(self.queue_size)
+        records: Queue = Queue(self.queue_size)
+        threads = [
+            threading.Thread(
+                target=self.guard,
+                args=(self.fetch, pages, start_page, end_page, from_uts),
+                name="fetch",
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self.guard,
+                args=(self.normalize, pages, records),
+                name="normalize",
+                daemon=True,
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            written = self.write(self.resolve(self.drain(records)))
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return written
+
+    def guard(self, stage: Any, *args: Any) -> None:
+        # Runs a threaded stage, handing its exception over to `run`.
+        try:
+            stage(*args)
+        except BaseException as E:
+            self.errors.append(E)
+            self.stop.set()
+
+    def put(self, queue: Queue, item: Any) -> bool:
+        # Blocks while `queue` is full, returns False if the pipeline is being torn down.
+        while not self.stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def drain(self, queue: Queue) -> Iterator[Any]:
+        # Yields items off `queue` until the producing stage is done (or failed).
+        while True:
+            try:
+                item = queue.get(timeout=0.1)
+            except Empty:
+                if self.stop.is_set():
+                    return
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def fetch(
+        self, pages: Queue, start_page: int, end_page: Optional[int], from_uts: Optional[int]
+    ) -> None:
+        page = start_page
+        while end_page is None or page <= end_page:
+            data = self.fetch_api.get_scrobble_data(
+                self.user, page, maxsize=self.page_size, from_uts=from_uts
+            )
+            if not self.put(pages, dict_fetch(data, "recenttracks", "track")):
+                return
+            total_pages = safe_int(dict_fetch(data, "recenttracks", "@attr", "totalPages"))
+            if page >= total_pages:
+                break
+            page += 1
+        self.put(pages, _DONE)
+
+    def normalize(self, pages: Queue, records: Queue) -> None:
+        for scrobbles in self.drain(pages):
+            if type(scrobbles) == dict:  # Single scrobble on this page, so we can't iterate
+                scrobbles = [scrobbles]  # Now we can iterate as usual
+            page_records = [
+                record
+                for scrobble in scrobbles or []
+                if (record := ScrobbleRecord.from_scrobble(scrobble)) is not None
+            ]
+            if not self.put(records, page_records):
+                return
+        self.put(records, _DONE)
+
+    def resolve(self, record_pages: Iterator[list[ScrobbleRecord]]) -> Iterator[ScrobbleRow]:
+        for page_records in record_pages:
+            for record in page_records:
+                if (row := self.scrobbles.resolve(record)) is not None:
+                    yield row
+
+    def write(self, rows: Iterator[ScrobbleRow]) -> int:
+        written = 0
+        batch: list[ScrobbleRow] = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                written += self.write_batch(batch)
+                batch = []
+        if batch:
+            written += self.write_batch(batch)
+        return written
+
+    def write_batch(self, batch: list[ScrobbleRow]) -> int:
+        # Rows already in the db, live or archived, are ignored, see `Scrobbles.handle_scrobble`.
+        # Returns the number of rows inserted. Ids are the ones `insert(hash_id="id")` would give,
+        # the insert is plain sql as its rowcount leaves out ignored rows and trigger writes.
+        batch = self.scrobbles.datalayer.unarchived(batch)
+        if not batch:
+            return 0
+        columns = SCROBBLE_COLUMNS.split(", ")
+        with self.db.conn:
+            cursor = self.db.conn.executemany(
+                f"""
+                insert or ignore into scrobbles ({SCROBBLE_COLUMNS})
+                values ({", ".join(":" + column for column in columns)})
+                """,
+                [dict(row, id=hash_record(row)) for row in batch],
+            )
+        return cursor.rowcount
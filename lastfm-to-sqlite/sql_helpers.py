@@ -1,217 +1,648 @@
-from typing import Callable, Optional
+from contextlib import contextmanager
+from sqlite3 import IntegrityError
+from typing import Callable, Iterator, Optional
+from weakref import WeakKeyDictionary
 
 from sqlite_utils import Database
 
+from dataclass import ScrobbleRow
+
+SCROBBLE_COLUMNS = "id, album_id, track_id, artist_id, timestamp, user, uts"
+# Scrobble timestamps are stored as "YYYY-MM-DDTHH:MM:SS".
+TIMESTAMP_FLOOR = "0000-01-01T00:00:00"
+# Sqlite's default cap on attached databases, see `DataLayer.attached`.
+MAX_ATTACHED = 10
+
+# Keep tag_cooccurrence and user_tag_weights in step with tag_mappings and scrobbles.
+# A scrobble adds weight to every tag of its track, artist and album, bucketed by month.
+# Archived scrobbles can't be read from a trigger, they count through archived_plays.
+TAG_AGGREGATE_TRIGGERS = {
+    "tag_mappings_after_insert": """
+        create trigger if not exists tag_mappings_after_insert after insert on tag_mappings begin
+            insert into tag_cooccurrence (tag_id, related_tag_id, count)
+                select new.tag_id, tag_id, 1 from tag_mappings
+                where media_id = new.media_id and tag_id != new.tag_id
+                on conflict do update set count = count + 1;
+            insert into tag_cooccurrence (tag_id, related_tag_id, count)
+                select tag_id, new.tag_id, 1 from tag_mappings
+                where media_id = new.media_id and tag_id != new.tag_id
+                on conflict do update set count = count + 1;
+            insert into user_tag_weights (user, month, tag_id, weight)
+                select user, substr(timestamp, 1, 7), new.tag_id, count(*) from scrobbles
+                where track_id = new.media_id or artist_id = new.media_id or album_id = new.media_id
+                group by user, substr(timestamp, 1, 7)
+                on conflict do update set weight = weight + excluded.weight;
+            insert into user_tag_weights (user, month, tag_id, weight)
+                select user, month, new.tag_id, sum(plays) from archived_plays
+                where media_id = new.media_id
+                group by user, month
+                on conflict do update set weight = weight + excluded.weight;
+        end
+    """,
+    "tag_mappings_after_delete": """
+        create trigger if not exists tag_mappings_after_delete after delete on tag_mappings begin
+            update tag_cooccurrence set count = count - 1
+                where (tag_id = old.tag_id and related_tag_id in (
+                    select tag_id from tag_mappings where media_id = old.media_id
+                ))
+                or (related_tag_id = old.tag_id and tag_id in (
+                    select tag_id from tag_mappings where media_id = old.media_id
+                ));
+            delete from tag_cooccurrence
+                where (tag_id = old.tag_id or related_tag_id = old.tag_id) and count <= 0;
+            update user_tag_weights set weight = weight - (
+                select count(*) from scrobbles
+                where (track_id = old.media_id or artist_id = old.media_id or album_id = old.media_id)
+                and scrobbles.user = user_tag_weights.user
+                and substr(scrobbles.timestamp, 1, 7) = user_tag_weights.month
+            ) - (
+                select coalesce(sum(plays), 0) from archived_plays
+                where media_id = old.media_id
+                and archived_plays.user = user_tag_weights.user
+                and archived_plays.month = user_tag_weights.month
+            )
+                where tag_id = old.tag_id;
+            delete from user_tag_weights where tag_id = old.tag_id and weight <= 0;
+        end
+    """,
+    "scrobbles_after_insert": """
+        create trigger if not exists scrobbles_after_insert after insert on scrobbles begin
+            insert into user_tag_weights (user, month, tag_id, weight)
+                select new.user, substr(new.timestamp, 1, 7), tag_id, count(*) from tag_mappings
+                where media_id in (new.track_id, new.artist_id, new.album_id)
+                group by tag_id
+                on conflict do update set weight = weight + excluded.weight;
+        end
+    """,
+    "scrobbles_after_delete": """
+        create trigger if not exists scrobbles_after_delete after delete on scrobbles begin
+            update user_tag_weights set weight = weight - (
+                select count(*) from tag_mappings
+                where media_id in (old.track_id, old.artist_id, old.album_id)
+                and tag_mappings.tag_id = user_tag_weights.tag_id
+            )
+                where user = old.user and month = substr(old.timestamp, 1, 7)
+                and tag_id in (
+                    select tag_id from tag_mappings
+                    where media_id in (old.track_id, old.artist_id, old.album_id)
+                );
+            delete from user_tag_weights
+                where user = old.user and month = substr(old.timestamp, 1, 7) and weight <= 0;
+        end
+    """,
+}
+
+# Per user, month and media play counts of the `{scrobbles}` rows matching `{where}`, added
+# onto `{target}`. A scrobble counts once for its track, once for its artist and its album.
+ARCHIVED_PLAYS_SUMMARY = """
+    insert into {target} (user, month, media_id, plays)
+    select user, substr(timestamp, 1, 7), media_id, count(*) from (
+        select user, timestamp, track_id as media_id from {scrobbles} where {where}
+        union all select user, timestamp, artist_id from {scrobbles} where {where}
+        union all select user, timestamp, album_id from {scrobbles} where {where}
+    )
+    where true
+    group by 1, 2, 3
+    on conflict do update set plays = plays + excluded.plays
+"""
+
+# The tables, by name. Foreign keys are declared inline, since adding them later means
+# rebuilding the whole table. `media_id` columns hold an artist, album or track id, which
+# no foreign key can express, so they have none.
+SCHEMA = {
+    # Single table for all collected entities. (Movies and Episodes.)
+    "tags": """
+    create table if not exists [tags] (
+        [id] TEXT PRIMARY KEY,
+        [name] TEXT NOT NULL,  -- tag name
+        [url] TEXT NOT NULL  -- tag lastfm url
+    )
+    """,
+    "artists": """
+    create table if not exists [artists] (
+        [id] TEXT PRIMARY KEY,  -- Hash.
+        [name] TEXT NOT NULL,
+        [url] TEXT NOT NULL,
+        [mbid] TEXT,
+        [bio] TEXT
+    )
+    """,
+    # To be processed. At this point similar artists might not exist in the db,
+    # and if we try to recursively poll the data it might go on for a long time.
+    # Instead, we store all the similarity data in a tmp db and later process
+    # this into another db.
+    "similar_artists_tmp": """
+    create table if not exists [similar_artists_tmp] (
+        [id] TEXT PRIMARY KEY,
+        [artist_id] TEXT NOT NULL,
+        [similar_artist_name] TEXT NOT NULL,
+        [similar_artist_url] TEXT NOT NULL
+    )
+    """,
+    "similar_artists": """
+    create table if not exists [similar_artists] (
+        [id] TEXT PRIMARY KEY,
+        [artist1_id] TEXT NOT NULL REFERENCES [artists]([id]),
+        [artist2_id] TEXT NOT NULL REFERENCES [artists]([id])
+    )
+    """,
+    "tracks": """
+    create table if not exists [tracks] (
+        [id] TEXT PRIMARY KEY,  -- Hash
+        [name] TEXT NOT NULL,
+        [url] TEXT NOT NULL,
+        [mbid] TEXT,
+        [duration] TEXT,
+        [bio] TEXT,
+        [artist_id] TEXT NOT NULL REFERENCES [artists]([id])
+    )
+    """,
+    "albums": """
+    create table if not exists [albums] (
+        [id] TEXT PRIMARY KEY,  -- Hash
+        [name] TEXT NOT NULL,
+        [url] TEXT NOT NULL,
+        [mbid] TEXT,
+        [bio] TEXT,
+        [artist_id] TEXT NOT NULL REFERENCES [artists]([id])
+    )
+    """,
+    "album_track_mappings": """
+    create table if not exists [album_track_mappings] (
+        [id] TEXT PRIMARY KEY,  -- Hash
+        [album_id] TEXT NOT NULL REFERENCES [albums]([id]),
+        [track_id] TEXT NOT NULL REFERENCES [tracks]([id])
+    )
+    """,
+    "stats": """
+    create table if not exists [stats] (
+        [id] TEXT PRIMARY KEY,
+        [media_id] TEXT NOT NULL,  -- Can be artist, track, album.
+        [listeners] TEXT NOT NULL,  -- total listeners
+        [playcount] TEXT NOT NULL,  -- total plays
+        [last_updated] TEXT,  -- timestamp when updated
+        [is_loved] INTEGER DEFAULT 0  -- bool to denote if track is loved or not
+    )
+    """,
+    "tag_mappings": """
+    create table if not exists [tag_mappings] (
+        [id] TEXT PRIMARY KEY,
+        [tag_id] TEXT NOT NULL REFERENCES [tags]([id]),
+        [media_id] TEXT NOT NULL  -- Can be artist, track, album.
+    )
+    """,
+    "scrobbles": """
+    create table if not exists [scrobbles] (
+        [id] TEXT PRIMARY KEY,  -- Hash
+        [album_id] TEXT NOT NULL REFERENCES [albums]([id]),
+        [track_id] TEXT NOT NULL REFERENCES [tracks]([id]),
+        [artist_id] TEXT NOT NULL REFERENCES [artists]([id]),
+        [timestamp] TEXT NOT NULL,
+        [user] TEXT NOT NULL DEFAULT '',  -- lastfm username
+        [uts] INTEGER  -- unix timestamp of the scrobble
+    )
+    """,
+    # Number of entities tagged with both tags. Stored in both directions.
+    "tag_cooccurrence": """
+    create table if not exists [tag_cooccurrence] (
+        [tag_id] TEXT,
+        [related_tag_id] TEXT,
+        [count] INTEGER NOT NULL,
+        PRIMARY KEY ([tag_id], [related_tag_id])
+    )
+    """,
+    # Per user, per month (YYYY-MM) tag weights, derived from tag_mappings x scrobbles.
+    "user_tag_weights": """
+    create table if not exists [user_tag_weights] (
+        [user] TEXT,
+        [month] TEXT,
+        [tag_id] TEXT,
+        [weight] INTEGER NOT NULL,
+        PRIMARY KEY ([user], [month], [tag_id])
+    )
+    """,
+    # Play counts of the archived scrobbles, see `archive.Archiver`. Lets the tag aggregates
+    # count archived plays without reading the partitions.
+    "archived_plays": """
+    create table if not exists [archived_plays] (
+        [user] TEXT,
+        [month] TEXT,
+        [media_id] TEXT,  -- Can be artist, track, album.
+        [plays] INTEGER NOT NULL,
+        PRIMARY KEY ([user], [month], [media_id])
+    )
+    """,
+}
+
+INDEXES = [
+    # Lookups done by `DataLayer.search_on_table` while resolving entities.
+    "create index if not exists idx_artists_name on artists (name)",
+    "create index if not exists idx_artists_mbid on artists (mbid)",
+    "create index if not exists idx_tracks_name on tracks (name)",
+    "create index if not exists idx_tracks_mbid on tracks (mbid)",
+    "create index if not exists idx_albums_name on albums (name)",
+    "create index if not exists idx_albums_mbid on albums (mbid)",
+    "create index if not exists idx_tags_name on tags (name)",
+    # Exports and range queries walk the history in timestamp order.
+    "create index if not exists idx_scrobbles_timestamp on scrobbles (timestamp)",
+    # Joins from tags to scrobbles, used by the tag aggregate triggers.
+    "create index if not exists idx_tag_mappings_media_id on tag_mappings (media_id)",
+    "create index if not exists idx_scrobbles_track_id on scrobbles (track_id)",
+    "create index if not exists idx_scrobbles_artist_id on scrobbles (artist_id)",
+    "create index if not exists idx_scrobbles_album_id on scrobbles (album_id)",
+    "create index if not exists idx_similar_artists_pair on similar_artists (artist1_id, artist2_id)",
+]
+
 
 class Datastore:
+    """
+    Creates and upgrades the schema. The schema version lives in sqlite's `user_version`,
+    and `migrations[n]` takes a db from version n to n + 1. Opening a db reads the version
+    once, and applies whatever is pending in a single transaction.
+    """
+
     def __init__(self, db: Database) -> None:
         self.db = db
-        self.required_tables: list[str] = [
-            "tags",
-            "artists",
-            "similar_artists_tmp",
-            "similar_artists",
-            "tracks",
-            "albums",
-            "album_track_mappings",
-            "stats",
-            "tag_mappings",
-            "scrobbles",
+        self.migrations: list[Callable[[], None]] = [
+            self.create_schema,
+            self.add_scrobble_natural_key,
+            self.create_indexes,
+            self.create_tag_aggregates,
+            self.create_archive_partitions,
+            self.create_loved_tracks,
+            self.drop_media_foreign_keys,
+            self.create_archived_plays,
         ]
-        self.table_mapping: dict[str, Callable[[], None]] = {
-            "tags": self.create_tags,
-            "stats": self.create_stats,
-            "tag_mappings": self.create_tag_mappings,
-            "artists": self.create_artists,
-            "similar_artists_tmp": self.create_similar_artists_tmp,
-            "similar_artists": self.create_similar_artists,
-            "albums": self.create_albums,
-            "tracks": self.create_tracks,
-            "album_track_mappings": self.create_album_track_mappings,
-            "scrobbles": self.create_scrobbles,
-        }
+
+    @property
+    def latest_version(self) -> int:
+        return len(self.migrations)
+
+    def version(self) -> int:
+        return self.db.execute("pragma user_version").fetchone()[0]
 
     def assert_tables(self) -> bool:
-        return all(
-            [
-                True if table in self.db.table_names() else False
-                for table in self.required_tables
-            ]
-        )
+        return self.version() == self.latest_version
 
-    def create_tables(self) -> None:
-        for table in self.required_tables:
-            if table not in self.db.table_names():
-                table_creation_func = self.table_mapping[table]
-                table_creation_func()
+    def create_tables(self) -> int:
+        # Kept under its old name, see `migrate`.
+        return self.migrate()
 
-    # Single table for all collected entities. (Movies and Episodes.)
-    def create_tags(self):
-        self.db["tags"].create(  # type: ignore
-            {
-                "id": str,
-                "name": str,  # tag name
-                "url": str,  # tag lastfm url
-            },
-            pk="id",
-            not_null={"name", "url"},
-        )
+    def migrate(self) -> int:
+        # Applies the pending migrations, returns the number applied.
+        version = self.version()
+        if version > self.latest_version:
+            raise RuntimeError(
+                f"Database schema version {version} is newer than this code ({self.latest_version})."
+            )
+        if version == self.latest_version:
+            return 0
 
-    def create_stats(self):
-        self.db["stats"].create(  # type: ignore
-            {
-                "id": str,
-                "media_id": str,  # Can be artist, track, album.
-                "listeners": str,  # total listeners
-                "playcount": str,  # total plays
-                "last_updated": str,  # timestamp when updated
-                "is_loved": bool,  # bool to denote if track is loved or not
-            },
-            pk="id",
-            not_null={"media_id", "listeners", "playcount"},
-            defaults={"is_loved": False},
-        )
+        # Only takes effect on a fresh db, before the first table is created.
+        # Lets `compact` hand freed pages back to the filesystem without a full VACUUM.
+        self.db.execute("pragma auto_vacuum = incremental")
 
-        self.db.add_foreign_keys(
-            [
-                ("stats", "media_id", "albums", "id"),
-                ("stats", "media_id", "artists", "id"),
-                ("stats", "media_id", "tracks", "id"),
-            ]
-        )
+        # Partitions can't be attached within the migration transaction, so whatever a migration
+        # needs from them is read beforehand.
+        partitions_version = self.migrations.index(self.create_archive_partitions) + 1
+        if partitions_version <= version <= self.migrations.index(self.create_archived_plays):
+            self.stage_archived_plays()
 
-    def create_tag_mappings(self):
-        self.db["tag_mappings"].create(  # type: ignore
-            {
-                "id": str,
-                "tag_id": str,
-                "media_id": str,  # Can be artist, track, album.
-            },
-            pk="id",
-            not_null={"media_id", "tag_id"},
-        )
+        conn = self.db.conn
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("begin immediate")
+        try:
+            for migration in self.migrations[version:]:
+                migration()
+            conn.execute(f"pragma user_version = {self.latest_version}")
+            conn.execute("commit")
+        except BaseException:
+            conn.execute("rollback")
+            raise
+        return self.latest_version - version
 
-        self.db.add_foreign_keys(
-            [
-                ("tag_mappings", "media_id", "albums", "id"),
-                ("tag_mappings", "media_id", "artists", "id"),
-                ("tag_mappings", "media_id", "tracks", "id"),
-                ("tag_mappings", "media_id", "tags", "id"),
-            ]
-        )
+    # Migrations. These run inside the migration transaction, so they must stick to plain
+    # sql : sqlite-utils table methods may commit on their own.
 
-    def create_artists(self):
-        self.db["artists"].create(  # type: ignore
-            {
-                "id": str,  # Hash.
-                "name": str,
-                "url": str,
-                "mbid": str,
-                "bio": str,
-            },
-            pk="id",
-            not_null={"name", "url"},
-        )
+    def create_schema(self) -> None:
+        for statement in SCHEMA.values():
+            self.db.execute(statement)
 
-    def create_similar_artists_tmp(self):
-        # To be processed. At this point similar artists might not exist in the db,
-        # and if we try to recursively poll the data it might go on for a long time.
-        # Instead, we store all the similarity data in a tmp db and later process
-        # this into another db.
-        self.db["similar_artists_tmp"].create(  # type: ignore
-            {
-                "id": str,
-                "artist_id": str,
-                "similar_artist_name": str,
-                "similar_artist_url": str,
-            },
-            pk="id",
-            not_null={"artist_id", "similar_artist_name", "similar_artist_url"},
+    def add_scrobble_natural_key(self) -> None:
+        # Scrobbles created before the natural key existed lack the `user` and `uts` columns.
+        # Add them, backfill `uts` from the (GMT+5:30) timestamp, and enforce the key.
+        columns = {row[1] for row in self.db.execute("pragma table_info(scrobbles)").fetchall()}
+        if "user" not in columns:
+            self.db.execute("alter table scrobbles add column [user] TEXT NOT NULL DEFAULT ''")
+        if "uts" not in columns:
+            self.db.execute("alter table scrobbles add column [uts] INTEGER")
+            self.db.execute(
+                "update scrobbles set uts = cast(strftime('%s', timestamp) as integer) - 19800 "
+                "where uts is null"
+            )
+        self.delete_duplicate_scrobbles()
+        self.db.execute(
+            "create unique index if not exists idx_scrobbles_natural_key "
+            "on scrobbles (user, uts, track_id)"
         )
 
-    def create_similar_artists(self):
-        self.db["similar_artists"].create(  # type: ignore
-            {
-                "id": str,
-                "artist1_id": str,
-                "artist2_id": str,
-            },
-            pk="id",
-            not_null={"artist1_id", "artist2_id"},
-        )
+    def create_indexes(self) -> None:
+        for statement in INDEXES:
+            self.db.execute(statement)
 
-        self.db.add_foreign_keys(
-            [
-                ("similar_artists", "artist1_id", "artists", "id"),
-                ("similar_artists", "artist2_id", "artists", "id"),
-            ]
-        )
+    def create_tag_aggregates(self) -> None:
+        for statement in TAG_AGGREGATE_TRIGGERS.values():
+            self.db.execute(statement)
+        self.rebuild_tag_aggregates()
 
-    def create_albums(self):
-        self.db["albums"].create(  # type: ignore
-            {
-                "id": str,  # Hash
-                "name": str,
-                "url": str,
-                "mbid": str,
-                "bio": str,
-                "artist_id": str,  # Foreign key
-            },
-            pk="id",
-            not_null={"name", "url", "artist_id"},
-            foreign_keys=["artist_id"],
+    def create_archive_partitions(self) -> None:
+        # Registry of the read-only scrobble archives, see `archive.Archiver`.
+        # [start_timestamp, end_timestamp) bound the scrobble timestamps the partition holds.
+        self.db.execute(
+            """
+            create table if not exists [archive_partitions] (
+                [name] TEXT PRIMARY KEY,
+                [path] TEXT NOT NULL,
+                [start_timestamp] TEXT NOT NULL,
+                [end_timestamp] TEXT NOT NULL,
+                [row_count] INTEGER NOT NULL
+            )
+            """
         )
 
-    def create_album_track_mappings(self):
-        self.db["album_track_mappings"].create(  # type: ignore
-            {"id": str, "album_id": str, "track_id": str},  # Hash
-            pk="id",
-            not_null={"album_id", "track_id"},
+    def rebuild_tag_aggregates(self) -> None:
+        # Recomputes tag_cooccurrence and user_tag_weights from tag_mappings x scrobbles.
+        self.db.execute("delete from tag_cooccurrence")
+        self.db.execute(
+            """
+            insert into tag_cooccurrence (tag_id, related_tag_id, count)
+            select a.tag_id, b.tag_id, count(*)
+            from tag_mappings a
+            join tag_mappings b on b.media_id = a.media_id and b.tag_id != a.tag_id
+            group by a.tag_id, b.tag_id
+            """
         )
-
-        self.db.add_foreign_keys(
-            [
-                ("album_track_mappings", "album_id", "albums", "id"),
-                ("album_track_mappings", "track_id", "tracks", "id"),
-            ]
+        self.db.execute("delete from user_tag_weights")
+        self.db.execute(
+            """
+            insert into user_tag_weights (user, month, tag_id, weight)
+            select user, month, tag_id, sum(weight) from (
+                select scrobbles.user, substr(scrobbles.timestamp, 1, 7) as month,
+                    tag_mappings.tag_id, count(*) as weight
+                from scrobbles
+                join tag_mappings on tag_mappings.media_id in (
+                    scrobbles.track_id, scrobbles.artist_id, scrobbles.album_id
+                )
+                group by 1, 2, 3
+                union all
+                select archived_plays.user, archived_plays.month, tag_mappings.tag_id,
+                    sum(archived_plays.plays)
+                from archived_plays
+                join tag_mappings on tag_mappings.media_id = archived_plays.media_id
+                group by 1, 2, 3
+            )
+            group by 1, 2, 3
+            """
         )
 
-    def create_tracks(self):
-        self.db["tracks"].create(  # type: ignore
-            {
-                "id": str,  # Hash
-                "name": str,
-                "url": str,
-                "mbid": str,
-                "duration": str,
-                "bio": str,
-                "artist_id": str,
-            },
-            pk="id",
-            not_null={"name", "url", "artist_id"},
-            foreign_keys=["artist_id"],
+    def create_loved_tracks(self) -> None:
+        # Every user's loved tracks, as last synced from user.getLovedTracks.
+        # track_id is filled in once the track is found in the tracks table.
+        self.db.execute(
+            """
+            create table if not exists [loved_tracks] (
+                [user] TEXT,
+                [artist_name] TEXT,
+                [track_name] TEXT,
+                [mbid] TEXT,
+                [uts] INTEGER NOT NULL,  -- when the track was loved
+                [track_id] TEXT REFERENCES [tracks]([id]),
+                PRIMARY KEY ([user], [artist_name], [track_name])
+            )
+            """
         )
+        self.db.execute(
+            "create index if not exists idx_loved_tracks_track_id on loved_tracks (track_id)"
+        )
+
+    def drop_media_foreign_keys(self) -> None:
+        # Older dbs declare foreign keys from `media_id` to albums, artists and tracks at once
+        # (and to tags, before version 1), which no row satisfies. Rebuild those tables from
+        # their current definition. Dropping tag_mappings drops its triggers and indexes, the
+        # triggers are all recreated since the scrobbles ones read tag_mappings too.
+        tables = [
+            table
+            for table in ["stats", "tag_mappings"]
+            if any(
+                key[3] == "media_id"
+                for key in self.db.execute(f"pragma foreign_key_list({table})").fetchall()
+            )
+        ]
+        if not tables:
+            return
+        for name in TAG_AGGREGATE_TRIGGERS:
+            self.db.execute(f"drop trigger if exists {name}")
+        for table in tables:
+            columns = ", ".join(
+                f"[{row[1]}]"
+                for row in self.db.execute(f"pragma table_info({table})").fetchall()
+            )
+            self.db.execute(SCHEMA[table].replace(f"[{table}]", f"[{table}_new]", 1))
+            self.db.execute(f"insert into [{table}_new] ({columns}) select {columns} from [{table}]")
+            self.db.execute(f"drop table [{table}]")
+            self.db.execute(f"alter table [{table}_new] rename to [{table}]")
+        self.create_indexes()
+        for statement in TAG_AGGREGATE_TRIGGERS.values():
+            self.db.execute(statement)
 
-    def create_scrobbles(self):
-        self.db["scrobbles"].create(  # type: ignore
-            {
-                "id": str,  # Hash
-                "album_id": str,
-                "track_id": str,
-                "artist_id": str,
-                "timestamp": str,
-            },
-            pk="id",
-            not_null={"album_id", "track_id", "artist_id", "timestamp"},
+    def create_archived_plays(self) -> None:
+        # Fills archived_plays from the partitions archived so far (see `stage_archived_plays`),
+        # then recreates the tag_mappings triggers, which now read it, and the tag aggregates.
+        self.db.execute(SCHEMA["archived_plays"])
+        self.db.execute(
+            "create index if not exists idx_archived_plays_media_id on archived_plays (media_id)"
         )
+        staged = self.db.execute(
+            "select 1 from sqlite_temp_master where name = 'archived_plays_staging'"
+        ).fetchone()
+        if staged:
+            self.db.execute("insert into archived_plays select * from temp.archived_plays_staging")
+            self.db.execute("drop table temp.archived_plays_staging")
+        for name in ["tag_mappings_after_insert", "tag_mappings_after_delete"]:
+            self.db.execute(f"drop trigger if exists {name}")
+            self.db.execute(TAG_AGGREGATE_TRIGGERS[name])
+        self.rebuild_tag_aggregates()
 
-        self.db.add_foreign_keys(
-            [
-                ("scrobbles", "album_id", "albums", "id"),
-                ("scrobbles", "track_id", "tracks", "id"),
-                ("scrobbles", "artist_id", "artists", "id"),
-            ]
+    def stage_archived_plays(self) -> None:
+        # Summarizes the partitions, one at a time, into a temp table for `create_archived_plays`.
+        self.db.execute("drop table if exists temp.archived_plays_staging")
+        self.db.execute(
+            SCHEMA["archived_plays"].replace(
+                "[archived_plays]", "temp.[archived_plays_staging]", 1
+            )
         )
+        for schema in DataLayer(self.db).each_partition():
+            with self.db.conn:
+                self.db.execute(
+                    ARCHIVED_PLAYS_SUMMARY.format(
+                        target="temp.archived_plays_staging",
+                        scrobbles=f"[{schema}].scrobbles",
+                        where="true",
+                    )
+                )
+
+    def delete_duplicate_scrobbles(self) -> int:
+        # Keeps the first row written for every (user, uts, track_id).
+        # Rows without a user (see `claim_scrobbles`) are duplicates of any user's copy.
+        deleted = self.db.execute(
+            """
+            delete from scrobbles where rowid not in (
+                select min(rowid) from scrobbles group by user, uts, track_id
+            )
+            """
+        ).rowcount
+        deleted += self.db.execute(
+            """
+            delete from scrobbles where rowid in (
+                select unowned.rowid from scrobbles unowned
+                join scrobbles owned on owned.uts = unowned.uts
+                and owned.track_id = unowned.track_id and owned.user != ''
+                where unowned.user = ''
+            )
+            """
+        ).rowcount
+        return deleted
+
+    def claim_scrobbles(self, user: str) -> int:
+        """
+        Hands the scrobbles written before the `user` column existed (user = '') over to `user`.
+        Dbs of that era only ever held one user's history. Rows the user already has a copy of
+        are dropped, and the tag weights move along. Returns the number of rows claimed.
+        """
+        if not user:
+            return 0
+        with self.db.conn:
+            self.db.execute(
+                """
+                delete from scrobbles where rowid in (
+                    select unowned.rowid from scrobbles unowned
+                    join scrobbles owned on owned.user = ? and owned.uts = unowned.uts
+                    and owned.track_id = unowned.track_id
+                    where unowned.user = ''
+                )
+                """,
+                [user],
+            )
+            claimed = self.db.execute(
+                "update scrobbles set user = ? where user = ''", [user]
+            ).rowcount
+            self.db.execute(
+                """
+                insert into user_tag_weights (user, month, tag_id, weight)
+                select ?, month, tag_id, weight from user_tag_weights where user = ''
+                on conflict do update set weight = weight + excluded.weight
+                """,
+                [user],
+            )
+            self.db.execute("delete from user_tag_weights where user = ''")
+            self.db.execute(
+                """
+                insert into archived_plays (user, month, media_id, plays)
+                select ?, month, media_id, plays from archived_plays where user = ''
+                on conflict do update set plays = plays + excluded.plays
+                """,
+                [user],
+            )
+            self.db.execute("delete from archived_plays where user = ''")
+        return claimed
+
+    def compact(self) -> dict[str, int]:
+        """
+        Removes duplicate and orphan rows across all tables, in set based sql, and then
+        releases the freed pages with an incremental vacuum.
+        Returns the number of deleted rows per table.
+        """
+        media = "select id from artists union all select id from albums union all select id from tracks"
+        deleted: dict[str, int] = {}
+        with self.db.conn:
+            deleted["scrobbles"] = self.delete_duplicate_scrobbles()
+            deleted["scrobbles"] += self.db.execute(
+                """
+                delete from scrobbles
+                where track_id not in (select id from tracks)
+                or artist_id not in (select id from artists)
+                or album_id not in (select id from albums)
+                """
+            ).rowcount
+            # Every stats write is a new row, only the latest one per media is meaningful.
+            deleted["stats"] = self.db.execute(
+                """
+                delete from stats where rowid in (
+                    select rowid from (
+                        select rowid, row_number() over (
+                            partition by media_id order by last_updated desc, rowid desc
+                        ) as rank
+                        from stats
+                    )
+                    where rank > 1
+                )
+                """
+            ).rowcount
+            deleted["stats"] += self.db.execute(
+                f"delete from stats where media_id not in ({media})"
+            ).rowcount
+            deleted["tag_mappings"] = self.db.execute(
+                f"""
+                delete from tag_mappings
+                where rowid not in (
+                    select min(rowid) from tag_mappings group by tag_id, media_id
+                )
+                or tag_id not in (select id from tags)
+                or media_id not in ({media})
+                """
+            ).rowcount
+            deleted["tags"] = self.db.execute(
+                "delete from tags where id not in (select tag_id from tag_mappings)"
+            ).rowcount
+            deleted["album_track_mappings"] = self.db.execute(
+                """
+                delete from album_track_mappings
+                where rowid not in (
+                    select min(rowid) from album_track_mappings group by album_id, track_id
+                )
+                or album_id not in (select id from albums)
+                or track_id not in (select id from tracks)
+                """
+            ).rowcount
+            deleted["similar_artists_tmp"] = self.db.execute(
+                "delete from similar_artists_tmp where artist_id not in (select id from artists)"
+            ).rowcount
+            deleted["similar_artists"] = self.db.execute(
+                """
+                delete from similar_artists
+                where rowid not in (
+                    select min(rowid) from similar_artists group by artist1_id, artist2_id
+                )
+                or artist1_id not in (select id from artists)
+                or artist2_id not in (select id from artists)
+                """
+            ).rowcount
+
+        # Orphan tags are gone, so their cached ids must not be handed out again.
+        TagInterner.for_db(self.db).clear()
+        self.vacuum()
+        return deleted
+
+    def vacuum(self) -> None:
+        # incremental_vacuum is a no-op unless auto_vacuum is INCREMENTAL (2). Dbs created before
+        # that was set need one full VACUUM to switch over, after which this stays cheap.
+        if self.db.execute("pragma auto_vacuum").fetchone()[0] != 2:
+            self.db.execute("pragma auto_vacuum = incremental")
+            self.db.execute("vacuum")
+        else:
+            # The pragma frees one page per step, executescript steps it to completion.
+            self.db.conn.executescript("pragma incremental_vacuum")
 
 
 class DataLayer:
@@ -238,3 +669,253 @@ class DataLayer:
             return results[0][0]
         else:
             return None
+
+    def attached_databases(self) -> dict[str, str]:
+        # Schema name -> file path, for every database attached to the connection.
+        return {row[1]: row[2] for row in self.db.execute("pragma database_list").fetchall()}
+
+    @staticmethod
+    def full_timestamp(value: str) -> str:
+        # Pads a timestamp prefix (eg : "2010" or "2010-01-01") to the stored format,
+        # so that it compares against stored timestamps as the instant it starts at.
+        return value + TIMESTAMP_FLOOR[len(value) :]
+
+    def partitions(
+        self, start: Optional[str] = None, end: Optional[str] = None
+    ) -> list[tuple[str, str]]:
+        # (schema name, path) of the archive partitions overlapping [start, end), oldest first.
+        cursor = self.db.execute(
+            """
+            select name, path from archive_partitions
+            where start_timestamp < ? and end_timestamp > ?
+            order by start_timestamp
+            """,
+            [self.full_timestamp(end) if end else "9999", self.full_timestamp(start or "")],
+        )
+        partitions = [(f"archive_{name}", path) for name, path in cursor.fetchall()]
+        cursor.close()
+        return partitions
+
+    @contextmanager
+    def attached(self, partitions: list[tuple[str, str]]) -> Iterator[list[str]]:
+        """
+        Attaches `partitions` for the duration of the block, and yields their schema names.
+        Sqlite caps attached databases at 10, so partitions are only attached while in use,
+        and those attached here are detached on the way out. Cursors over them must be closed
+        before the block ends.
+        """
+        attached = self.attached_databases()
+        in_use = [schema for schema in attached if schema not in ("main", "temp")]
+        if len(in_use) + len([p for p in partitions if p[0] not in attached]) > MAX_ATTACHED:
+            raise ValueError(
+                f"Can't attach {len(partitions)} partitions at once, read them one by one."
+            )
+        opened = []
+        try:
+            for schema, path in partitions:
+                if schema not in attached:
+                    self.db.execute(f"attach database ? as [{schema}]", [path])
+                    opened.append(schema)
+            yield [schema for schema, _ in partitions]
+        finally:
+            for schema in opened:
+                self.db.execute(f"detach database [{schema}]")
+
+    def each_partition(
+        self, start: Optional[str] = None, end: Optional[str] = None
+    ) -> Iterator[str]:
+        # Attaches the partitions overlapping [start, end) one at a time, yielding each schema.
+        for partition in self.partitions(start, end):
+            with self.attached([partition]) as schemas:
+                yield schemas[0]
+
+    @contextmanager
+    def scrobbles_view(self, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[str]:
+        """
+        Yields the name of a temporary view unioning live scrobbles with the archive partitions
+        overlapping [start, end). Partitions outside the range aren't attached nor scanned.
+        Meant for short ranges (partitions are yearly), wider reads go through `each_partition`.
+        """
+        with self.attached(self.partitions(start, end)) as schemas:
+            if not schemas:
+                yield "scrobbles"
+                return
+            view = "scrobbles_" + "_".join(schemas)
+            union = " union all ".join(
+                f"select {SCROBBLE_COLUMNS} from [{schema}].scrobbles"
+                for schema in ["main", *schemas]
+            )
+            self.db.execute(f"create temp view if not exists [{view}] as {union}")
+            try:
+                yield view
+            finally:
+                self.db.execute(f"drop view temp.[{view}]")
+
+    def unarchived(self, rows: list[ScrobbleRow]) -> list[ScrobbleRow]:
+        """
+        Drops the rows whose (user, uts, track_id) is already in the archive partition covering
+        their timestamp. The live table's unique index can't see those, and re-inserting them
+        would count them twice in the tag aggregates. Rows archived before they had a user
+        (see `Datastore.claim_scrobbles`) count as any user's.
+        """
+        cursor = self.db.execute(
+            "select name, path, start_timestamp, end_timestamp from archive_partitions"
+        )
+        partitions = cursor.fetchall()
+        cursor.close()
+        if not partitions:
+            return rows
+
+        by_partition: dict[tuple[str, str], list[ScrobbleRow]] = {}
+        for row in rows:
+            for name, path, start, end in partitions:
+                if start <= row["timestamp"] < end:
+                    by_partition.setdefault((f"archive_{name}", path), []).append(row)
+                    break
+
+        archived = set()
+        for partition, partition_rows in by_partition.items():
+            with self.attached([partition]) as (schema,):
+                for row in partition_rows:
+                    cursor = self.db.execute(
+                        f"""
+                        select 1 from [{schema}].scrobbles
+                        where user in (?, '') and uts = ? and track_id = ?
+                        """,
+                        [row["user"], row["uts"], row["track_id"]],
+                    )
+                    if cursor.fetchone():
+                        archived.add(id(row))
+                    cursor.close()
+        return [row for row in rows if id(row) not in archived]
+
+    def scrobbles_between(
+        self, start: str, end: str, user: Optional[str] = None
+    ) -> list[tuple[str, str, str, str, str, str, int]]:
+        # Scrobble rows with a timestamp in [start, end), live and archived, oldest first.
+        # Each partition is read on its own, so any range works whatever the partition count.
+        where = "where timestamp >= ? and timestamp < ?"
+        params: list[str] = [self.full_timestamp(start), self.full_timestamp(end)]
+        if user is not None:
+            where += " and user = ?"
+            params.append(user)
+
+        def read(schema: str) -> list[tuple[str, str, str, str, str, str, int]]:
+            cursor = self.db.execute(
+                f"select {SCROBBLE_COLUMNS} from [{schema}].scrobbles {where}", params
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+
+        results = read("main")
+        for schema in self.each_partition(start, end):
+            results += read(schema)
+        return sorted(results, key=lambda row: row[4])
+
+    def resolve_similar_artists(self) -> int:
+        """
+        Moves similarity pairs out of `similar_artists_tmp` into `similar_artists`,
+        for every similar artist that has since made it into the artists table.
+        Returns the number of new pairs.
+        """
+        cursor = self.db.execute(
+            """
+            select similar_artists_tmp.artist_id, artists.id
+            from similar_artists_tmp
+            join artists on artists.name = similar_artists_tmp.similar_artist_name
+            where not exists (
+                select 1 from similar_artists
+                where similar_artists.artist1_id = similar_artists_tmp.artist_id
+                and similar_artists.artist2_id = artists.id
+            )
+            """
+        )
+        rows = [{"artist1_id": a1, "artist2_id": a2} for a1, a2 in cursor.fetchall()]
+        cursor.close()
+        self.db["similar_artists"].insert_all(rows, hash_id="id", ignore=True)
+        return len(rows)
+
+    def top_tags(
+        self, user: str, start_month: str, end_month: Optional[str] = None, limit: int = 10
+    ) -> list[tuple[str, int]]:
+        # Tag names and weights for a user, over the months (YYYY-MM) in [start_month, end_month].
+        cursor = self.db.execute(
+            """
+            select tags.name, sum(user_tag_weights.weight) as weight
+            from user_tag_weights
+            join tags on tags.id = user_tag_weights.tag_id
+            where user_tag_weights.user = ? and user_tag_weights.month between ? and ?
+            group by user_tag_weights.tag_id
+            order by weight desc
+            limit ?
+            """,
+            [user, start_month, end_month or start_month, limit],
+        )
+        results = cursor.fetchall()
+        cursor.close()
+        return results
+
+    def related_tags(self, tag_name: str, limit: int = 10) -> list[tuple[str, int]]:
+        # Tag names most often found on the same entities as `tag_name`, with their counts.
+        cursor = self.db.execute(
+            """
+            select related.name, tag_cooccurrence.count
+            from tags
+            join tag_cooccurrence on tag_cooccurrence.tag_id = tags.id
+            join tags related on related.id = tag_cooccurrence.related_tag_id
+            where tags.name = ?
+            order by tag_cooccurrence.count desc
+            limit ?
+            """,
+            [tag_name, limit],
+        )
+        results = cursor.fetchall()
+        cursor.close()
+        return results
+
+
+class TagInterner:
+    """
+    In-memory tag dictionary for the write path, keyed by normalized tag name.
+    The tags table is read once, after which resolving a known tag is a dict lookup.
+    One interner is kept per `Database`, get it with `TagInterner.for_db(db)`.
+    """
+
+    _interners: "WeakKeyDictionary[Database, TagInterner]" = WeakKeyDictionary()
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+        self.tag_ids: Optional[dict[str, str]] = None
+
+    @classmethod
+    def for_db(cls, db: Database) -> "TagInterner":
+        if db not in cls._interners:
+            cls._interners[db] = cls(db)
+        return cls._interners[db]
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        return " ".join(name.split()).lower()
+
+    def clear(self) -> None:
+        self.tag_ids = None
+
+    def get_or_create_tag_id(self, tag: dict[str, str]) -> str:
+        if self.tag_ids is None:
+            self.tag_ids = {
+                self.normalize(name): tag_id
+                for tag_id, name in self.db.execute("select id, name from tags").fetchall()
+            }
+
+        key = self.normalize(tag["name"])
+        tag_id = self.tag_ids.get(key)
+        if tag_id is None:
+            try:
+                tag_id = self.db["tags"].insert(tag, hash_id="id").last_pk
+            except IntegrityError:  # Written by someone else since the tags were read.
+                tag_id = DataLayer(self.db).search_on_table(
+                    "tags", "name", tag["name"], "id"
+                )
+            self.tag_ids[key] = tag_id
+        return tag_id
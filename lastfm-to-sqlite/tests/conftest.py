@@ -0,0 +1,32 @@
+import os
+import sys
+from typing import Any
+
+import pytest
+from sqlite_utils import Database
+
+# The modules import each other as top level modules, like when run from this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sql_helpers import Datastore  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path: Any) -> Database:
+    db = Database(str(tmp_path / "lastfm.db"))
+    Datastore(db).create_tables()
+    return db
+
+
+def scrobble(
+    timestamp: str, track_id: str = "track", user: str = "user", uts: int = 0
+) -> dict[str, Any]:
+    # A scrobbles row, `uts` defaults to a value unique per timestamp.
+    return {
+        "album_id": "album",
+        "track_id": track_id,
+        "artist_id": "artist",
+        "timestamp": timestamp,
+        "user": user,
+        "uts": uts or int(timestamp[:4] + timestamp[5:7] + timestamp[8:10]),
+    }
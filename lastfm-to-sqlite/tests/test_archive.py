@@ -0,0 +1,108 @@
+from typing import Any
+
+from sqlite_utils import Database
+
+from api import API
+from archive import Archiver
+from conftest import scrobble
+from pipeline import ScrobblePipeline
+from sql_helpers import Datastore, DataLayer
+
+YEARS = range(2004, 2020)  # More partitions than sqlite attaches at once.
+
+
+def archive_years(db: Database, tmp_path: Any) -> list[dict[str, Any]]:
+    rows = [scrobble(f"{year}-06-01T00:00:00") for year in YEARS]
+    db["scrobbles"].insert_all(rows, hash_id="id")
+    Archiver(db, str(tmp_path / "archive")).archive_closed_years()
+    return rows
+
+
+def attached_partitions(db: Database) -> list[str]:
+    return [schema for schema in DataLayer(db).attached_databases() if schema.startswith("archive_")]
+
+
+def test_archive_moves_closed_years(db: Database, tmp_path: Any) -> None:
+    archive_years(db, tmp_path)
+    assert db["scrobbles"].count == 0
+    assert db["archive_partitions"].count == len(YEARS)
+    assert not attached_partitions(db)
+
+
+def test_scrobbles_between_reads_every_partition(db: Database, tmp_path: Any) -> None:
+    archive_years(db, tmp_path)
+    db["scrobbles"].insert(scrobble("2011-07-01T00:00:00"), hash_id="id")
+    datalayer = DataLayer(db)
+    rows = datalayer.scrobbles_between("2000", "2030", "user")
+    assert len(rows) == len(YEARS) + 1
+    assert [row[4] for row in rows] == sorted(row[4] for row in rows)
+    assert not attached_partitions(db)
+
+
+def test_unarchived_with_many_partitions(db: Database, tmp_path: Any) -> None:
+    rows = archive_years(db, tmp_path)
+    new = [scrobble(f"{year}-07-01T00:00:00") for year in YEARS]
+    assert DataLayer(db).unarchived(rows + new) == new
+
+
+def test_partitions_prune_on_date_bounds(db: Database, tmp_path: Any) -> None:
+    archive_years(db, tmp_path)
+    partitions = DataLayer(db).partitions("2010-01-01", "2013-01-01")
+    assert [schema for schema, _ in partitions] == ["archive_2010", "archive_2011", "archive_2012"]
+
+
+def test_scrobbles_view_detaches(db: Database, tmp_path: Any) -> None:
+    archive_years(db, tmp_path)
+    datalayer = DataLayer(db)
+    with datalayer.scrobbles_view("2010", "2011") as scrobbles:
+        assert db.execute(f"select count(*) from {scrobbles}").fetchone()[0] == 1
+    assert not attached_partitions(db)
+
+
+def weights(db: Database) -> list[tuple[str, str, str, int]]:
+    return db.execute("select * from user_tag_weights order by 1, 2, 3").fetchall()
+
+
+def test_tags_mapped_after_archiving_count_archived_plays(db: Database, tmp_path: Any) -> None:
+    archive_years(db, tmp_path)
+    db["tags"].insert({"id": "rock", "name": "rock", "url": ""})
+    db["tag_mappings"].insert({"id": "m", "tag_id": "rock", "media_id": "artist"})
+    assert DataLayer(db).top_tags("user", "2004-01", "2019-12") == [("rock", len(YEARS))]
+
+    incremental = weights(db)
+    with db.conn:
+        Datastore(db).rebuild_tag_aggregates()
+    assert weights(db) == incremental
+
+    db["tag_mappings"].delete("m")
+    assert weights(db) == []
+
+
+def test_reingest_after_archiving_does_not_double_count(db: Database, tmp_path: Any) -> None:
+    db["tags"].insert({"id": "rock", "name": "rock", "url": ""})
+    db["tag_mappings"].insert({"id": "m", "tag_id": "rock", "media_id": "track"})
+    rows = archive_years(db, tmp_path)
+    before = weights(db)
+
+    pipeline = ScrobblePipeline(db, API("key"), "user")
+    pipeline.write_batch(rows)
+    db["scrobbles"].insert(rows[0], hash_id="id")  # Written before the archive check existed.
+    Archiver(db, str(tmp_path / "archive")).archive_year(2004)
+    assert db["scrobbles"].count == 0
+    assert weights(db) == before
+
+
+def test_migration_summarizes_existing_partitions(db: Database, tmp_path: Any) -> None:
+    db["tags"].insert({"id": "rock", "name": "rock", "url": ""})
+    archive_years(db, tmp_path)
+    # As left by a version 7 db : no archived plays, and tags mapped since archiving count 0.
+    with db.conn:
+        db.execute("delete from archived_plays")
+        db.execute("drop trigger tag_mappings_after_insert")
+        db.execute("pragma user_version = 7")
+    db["tag_mappings"].insert({"id": "m", "tag_id": "rock", "media_id": "album"})
+    assert weights(db) == []
+
+    Datastore(db).create_tables()
+    assert DataLayer(db).top_tags("user", "2004-01", "2019-12") == [("rock", len(YEARS))]
+    assert not attached_partitions(db)
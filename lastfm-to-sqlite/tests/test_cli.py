@@ -0,0 +1,24 @@
+from typing import Any
+
+from sqlite_utils import Database
+
+from archive import Archiver
+from cli import latest_uts
+from conftest import scrobble
+
+
+def test_latest_uts_prefers_the_live_table(db: Database, tmp_path: Any) -> None:
+    db["scrobbles"].insert_all(
+        [scrobble(f"{year}-06-01T00:00:00") for year in range(2004, 2020)], hash_id="id"
+    )
+    Archiver(db, str(tmp_path / "archive")).archive_closed_years()
+    assert latest_uts(db, "user") == 20190601
+    assert latest_uts(db, "other") is None
+
+    db["scrobbles"].insert(scrobble("2011-01-01T00:00:00", uts=1), hash_id="id")
+    assert latest_uts(db, "user") == 1
+
+
+def test_latest_uts_counts_unowned_scrobbles(db: Database) -> None:
+    db["scrobbles"].insert(scrobble("2023-01-01T00:00:00", user=""), hash_id="id")
+    assert latest_uts(db, "user") == 20230101
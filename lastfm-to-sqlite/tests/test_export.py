@@ -0,0 +1,48 @@
+import json
+import os
+from typing import Any
+
+import pyarrow.parquet as pq
+from sqlite_utils import Database
+
+from archive import Archiver
+from conftest import scrobble
+from export import HistoryExporter
+
+
+def read(out_dir: str) -> list[dict[str, Any]]:
+    return pq.read_table(out_dir).to_pylist()
+
+
+def test_export_across_many_partitions(db: Database, tmp_path: Any) -> None:
+    rows = [scrobble(f"{year}-06-01T00:00:00", user="ann") for year in range(2004, 2020)]
+    rows.append(scrobble("2019-06-02T00:00:00", user="bob"))
+    db["scrobbles"].insert_all(rows, hash_id="id")
+    Archiver(db, str(tmp_path / "archive")).archive_closed_years()
+    out_dir = str(tmp_path / "export")
+
+    assert HistoryExporter(db, out_dir).export() == len(rows)
+    exported = read(out_dir)
+    assert sorted((row["user"], row["uts"]) for row in exported) == sorted(
+        (row["user"], row["uts"]) for row in rows
+    )
+    assert HistoryExporter(db, out_dir).export() == 0
+
+
+def test_export_rewrites_months_exported_with_other_columns(db: Database, tmp_path: Any) -> None:
+    db["scrobbles"].insert_all(
+        [scrobble("2023-01-01T00:00:00"), scrobble("2023-02-01T00:00:00")], hash_id="id"
+    )
+    out_dir = str(tmp_path / "export")
+    HistoryExporter(db, out_dir).export()
+    # A manifest as written before the export had the user and uts columns.
+    manifest_path = os.path.join(out_dir, "_manifest.json")
+    with open(manifest_path) as f:
+        months = json.load(f)["months"]
+    months["2022-12"] = [1, 1]
+    with open(manifest_path, "w") as f:
+        json.dump(months, f)
+    os.makedirs(os.path.join(out_dir, "month=2022-12"))
+
+    assert HistoryExporter(db, out_dir).export() == 2
+    assert sorted(os.listdir(out_dir)) == ["_manifest.json", "month=2023-01", "month=2023-02"]
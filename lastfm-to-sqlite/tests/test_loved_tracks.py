@@ -0,0 +1,50 @@
+from typing import Any
+
+from sqlite_utils import Database
+
+from parse import LovedTracks
+
+
+class LovedTracksAPI:
+    # Serves `loved` (artist, track, uts), most recent first, one track per page.
+    def __init__(self, loved: list[tuple[str, str, int]]) -> None:
+        self.loved = loved
+
+    def get_loved_tracks(self, user: str, page: int, maxsize: int = 1000) -> dict[str, Any]:
+        tracks = [
+            {"name": name, "mbid": "", "artist": {"name": artist}, "date": {"uts": str(uts)}}
+            for artist, name, uts in self.loved
+        ]
+        return {
+            "lovedtracks": {
+                "track": tracks[page - 1 : page],
+                "@attr": {"totalPages": str(len(tracks))},
+            }
+        }
+
+
+def loved_names(db: Database) -> list[str]:
+    return [row[0] for row in db.execute("select track_name from loved_tracks order by 1")]
+
+
+def test_incremental_sync_keeps_tracks_loved_in_the_same_second(db: Database) -> None:
+    api = LovedTracksAPI([("artist", "one", 100)])
+    LovedTracks(db, api, "user").sync()
+    api.loved.insert(0, ("artist", "two", 100))
+    LovedTracks(db, api, "user").sync()
+    assert loved_names(db) == ["one", "two"]
+
+
+def test_sync_sets_is_loved(db: Database) -> None:
+    db["artists"].insert({"id": "artist", "name": "artist", "url": ""})
+    for name in ["one", "two"]:
+        db["tracks"].insert({"id": name, "name": name, "url": "", "artist_id": "artist"})
+        db["stats"].insert(
+            {"id": name, "media_id": name, "listeners": "1", "playcount": "1", "is_loved": None}
+        )
+    api = LovedTracksAPI([("artist", "one", 200), ("artist", "undated", 0)])
+    assert LovedTracks(db, api, "user").sync(full=True) == 1
+    assert db.execute("select media_id, is_loved from stats order by 1").fetchall() == [
+        ("one", 1),
+        ("two", 0),
+    ]
@@ -0,0 +1,126 @@
+import sqlite3
+from typing import Any
+
+import pytest
+from sqlite_utils import Database
+
+from sql_helpers import Datastore, DataLayer
+
+# The tables as created before schema versioning (version 0), by sqlite-utils.
+LEGACY_SCHEMA = """
+create table tags (id TEXT PRIMARY KEY, name TEXT NOT NULL, url TEXT NOT NULL);
+create table artists (
+    id TEXT PRIMARY KEY, name TEXT NOT NULL, url TEXT NOT NULL, mbid TEXT, bio TEXT
+);
+create table similar_artists_tmp (
+    id TEXT PRIMARY KEY, artist_id TEXT NOT NULL,
+    similar_artist_name TEXT NOT NULL, similar_artist_url TEXT NOT NULL
+);
+create table similar_artists (
+    id TEXT PRIMARY KEY,
+    artist1_id TEXT NOT NULL REFERENCES artists(id),
+    artist2_id TEXT NOT NULL REFERENCES artists(id)
+);
+create table tracks (
+    id TEXT PRIMARY KEY, name TEXT NOT NULL, url TEXT NOT NULL, mbid TEXT, duration TEXT,
+    bio TEXT, artist_id TEXT NOT NULL REFERENCES artists(id)
+);
+create table albums (
+    id TEXT PRIMARY KEY, name TEXT NOT NULL, url TEXT NOT NULL, mbid TEXT, bio TEXT,
+    artist_id TEXT NOT NULL REFERENCES artists(id)
+);
+create table album_track_mappings (
+    id TEXT PRIMARY KEY,
+    album_id TEXT NOT NULL REFERENCES albums(id),
+    track_id TEXT NOT NULL REFERENCES tracks(id)
+);
+create table stats (
+    id TEXT PRIMARY KEY, media_id TEXT NOT NULL, listeners TEXT NOT NULL,
+    playcount TEXT NOT NULL, last_updated TEXT, is_loved INTEGER DEFAULT 0,
+    FOREIGN KEY(media_id) REFERENCES albums(id),
+    FOREIGN KEY(media_id) REFERENCES artists(id),
+    FOREIGN KEY(media_id) REFERENCES tracks(id)
+);
+create table tag_mappings (
+    id TEXT PRIMARY KEY, tag_id TEXT NOT NULL, media_id TEXT NOT NULL,
+    FOREIGN KEY(media_id) REFERENCES albums(id),
+    FOREIGN KEY(media_id) REFERENCES artists(id),
+    FOREIGN KEY(media_id) REFERENCES tracks(id),
+    FOREIGN KEY(media_id) REFERENCES tags(id)
+);
+create table scrobbles (
+    id TEXT PRIMARY KEY,
+    album_id TEXT NOT NULL REFERENCES albums(id),
+    track_id TEXT NOT NULL REFERENCES tracks(id),
+    artist_id TEXT NOT NULL REFERENCES artists(id),
+    timestamp TEXT NOT NULL
+);
+"""
+
+
+@pytest.fixture
+def legacy_db(tmp_path: Any) -> Database:
+    db = Database(str(tmp_path / "legacy.db"))
+    db.conn.executescript(LEGACY_SCHEMA)
+    db["tags"].insert({"id": "rock", "name": "rock", "url": ""})
+    db["tag_mappings"].insert({"id": "m", "tag_id": "rock", "media_id": "artist"})
+    db["stats"].insert({"id": "s", "media_id": "track", "listeners": "1", "playcount": "1"})
+    scrobble = {"album_id": "album", "track_id": "track", "artist_id": "artist"}
+    db["scrobbles"].insert_all(
+        [
+            dict(scrobble, id="a", timestamp="2023-05-01T12:00:00"),
+            dict(scrobble, id="b", timestamp="2023-05-01T12:00:00"),  # Fetched twice.
+            dict(scrobble, id="c", timestamp="2023-05-02T12:00:00"),
+        ]
+    )
+    return db
+
+
+def test_legacy_db_migrates_to_latest(legacy_db: Database) -> None:
+    datastore = Datastore(legacy_db)
+    assert datastore.version() == 0
+    assert datastore.migrate() == datastore.latest_version
+    assert datastore.assert_tables()
+
+    for table in ["stats", "tag_mappings"]:
+        keys = legacy_db.execute(f"pragma foreign_key_list({table})").fetchall()
+        assert all(key[3] != "media_id" for key in keys)
+    assert legacy_db["stats"].count == 1
+    assert legacy_db["tag_mappings"].count == 1
+
+    # Duplicates are gone, and the natural key holds with a uts backfilled in GMT.
+    assert legacy_db.execute("select id, user, uts from scrobbles order by id").fetchall() == [
+        ("a", "", 1682922600),
+        ("c", "", 1683009000),
+    ]
+    with pytest.raises(sqlite3.IntegrityError):
+        legacy_db.execute(
+            "insert into scrobbles (id, album_id, track_id, artist_id, timestamp, user, uts) "
+            "values ('d', 'album', 'track', 'artist', '2023-05-01T12:00:00', '', 1682922600)"
+        )
+
+    # Triggers are in place : the legacy plays count, and new plays are added.
+    assert DataLayer(legacy_db).top_tags("", "2023-05") == [("rock", 2)]
+    legacy_db.execute(
+        "insert into scrobbles (id, album_id, track_id, artist_id, timestamp, user, uts) "
+        "values ('e', 'album', 'track', 'artist', '2023-05-03T12:00:00', '', 1683095400)"
+    )
+    assert DataLayer(legacy_db).top_tags("", "2023-05") == [("rock", 3)]
+
+
+def test_legacy_plays_are_claimed(legacy_db: Database) -> None:
+    datastore = Datastore(legacy_db)
+    datastore.migrate()
+    assert datastore.claim_scrobbles("user") == 2
+    assert DataLayer(legacy_db).top_tags("user", "2023-05") == [("rock", 2)]
+    assert DataLayer(legacy_db).top_tags("", "2023-05") == []
+
+
+def test_migrate_is_a_no_op_when_current(db: Database) -> None:
+    assert Datastore(db).migrate() == 0
+
+
+def test_newer_db_is_refused(db: Database) -> None:
+    db.execute(f"pragma user_version = {Datastore(db).latest_version + 1}")
+    with pytest.raises(RuntimeError):
+        Datastore(db).migrate()
@@ -0,0 +1,26 @@
+from sqlite_utils import Database
+
+from api import API
+from conftest import scrobble
+from pipeline import ScrobblePipeline
+
+
+def test_write_batch_counts_new_rows_only(db: Database) -> None:
+    db["tags"].insert({"id": "rock", "name": "rock", "url": ""})
+    db["tag_mappings"].insert({"id": "m", "tag_id": "rock", "media_id": "track"})
+    pipeline = ScrobblePipeline(db, API("key"), "user")
+    rows = [scrobble(f"2023-01-{day:02d}T00:00:00") for day in range(1, 10)]
+
+    assert pipeline.write_batch(rows) == 9
+    assert pipeline.write_batch(rows) == 0
+    assert pipeline.write_batch(rows + [scrobble("2023-02-01T00:00:00")]) == 1
+    assert db["scrobbles"].count == 10
+
+
+def test_write_batch_ids_match_sqlite_utils(db: Database) -> None:
+    row = scrobble("2023-01-01T00:00:00")
+    ScrobblePipeline(db, API("key"), "user").write_batch([row])
+    assert db["scrobbles"].insert(row, hash_id="id", ignore=True).last_pk == next(
+        db["scrobbles"].rows
+    )["id"]
+    assert db["scrobbles"].count == 1
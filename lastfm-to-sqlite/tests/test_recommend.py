@@ -0,0 +1,76 @@
+from typing import Any
+
+import pytest
+from sqlite_utils import Database
+
+from archive import Archiver
+from conftest import scrobble
+from recommend import Recommender
+
+
+def similar(db: Database, artist: str, *others: str) -> None:
+    db["artists"].insert_all(
+        [{"id": a_id, "name": a_id, "url": ""} for a_id in [artist, *others]], pk="id", ignore=True
+    )
+    db["similar_artists"].insert_all(
+        [{"artist1_id": artist, "artist2_id": other} for other in others], hash_id="id"
+    )
+
+
+def plays(db: Database, artist: str, timestamps: list[str]) -> None:
+    db["scrobbles"].insert_all(
+        [dict(scrobble(timestamp, track_id=artist), artist_id=artist) for timestamp in timestamps],
+        hash_id="id",
+    )
+
+
+def total_plays(recommender: Recommender) -> float:
+    return float(recommender.graph.plays.sum())
+
+
+@pytest.mark.parametrize("method", ["neighbours", "rwr"])
+def test_recommends_unheard_similar_artists(db: Database, tmp_path: Any, method: str) -> None:
+    similar(db, "a", "b", "c")
+    similar(db, "c", "d")
+    plays(db, "a", ["2023-01-01T00:00:00", "2023-01-02T00:00:00"])
+    plays(db, "c", ["2023-01-03T00:00:00"])
+    ranked = Recommender(db, str(tmp_path / "cache")).recommend("user", method=method)
+    assert {a_id for a_id, _, _ in ranked} == {"b", "d"}
+
+
+def test_rebuild_reads_partitions_one_by_one(db: Database, tmp_path: Any) -> None:
+    similar(db, "a", "b")
+    plays(db, "a", [f"{year}-06-01T00:00:00" for year in range(2004, 2020)])
+    plays(db, "a", ["2026-06-01T00:00:00"])
+    Archiver(db, str(tmp_path / "archive")).archive_closed_years()
+    recommender = Recommender(db, str(tmp_path / "cache"))
+    assert total_plays(recommender) == 17
+    assert recommender.recommend("user")[0][0] == "b"
+
+
+def test_update_rebuilds_after_rowids_are_renumbered(db: Database, tmp_path: Any) -> None:
+    similar(db, "a", "b")
+    plays(db, "a", [f"2023-01-{day:02d}T00:00:00" for day in range(1, 11)])
+    cache = str(tmp_path / "cache")
+    assert total_plays(Recommender(db, cache)) == 10
+
+    # Rows written back in another order get other rowids, as after a VACUUM.
+    rows = list(db["scrobbles"].rows)[5:]
+    with db.conn:
+        db.execute("delete from scrobbles")
+    db["scrobbles"].insert_all(reversed(rows))
+    plays(db, "b", ["2023-02-01T00:00:00"])
+    recommender = Recommender(db, cache)
+    recommender.refresh()
+    assert total_plays(recommender) == 6
+    assert not recommender.graph.update()
+
+
+def test_rebuild_after_deletes(db: Database, tmp_path: Any) -> None:
+    similar(db, "a", "b")
+    plays(db, "a", [f"2023-01-{day:02d}T00:00:00" for day in range(1, 11)])
+    recommender = Recommender(db, str(tmp_path / "cache"))
+    with db.conn:
+        db.execute("delete from scrobbles where timestamp < '2023-01-06'")
+    recommender.graph.rebuild()
+    assert total_plays(recommender) == 5
@@ -0,0 +1,73 @@
+from typing import Any
+
+from sqlite_utils import Database
+
+from conftest import scrobble
+from sql_helpers import Datastore, DataLayer
+
+
+def aggregates(db: Database) -> tuple[list[Any], list[Any]]:
+    return (
+        db.execute("select * from tag_cooccurrence order by 1, 2").fetchall(),
+        db.execute("select * from user_tag_weights order by 1, 2, 3").fetchall(),
+    )
+
+
+def rebuilt(db: Database) -> tuple[list[Any], list[Any]]:
+    with db.conn:
+        Datastore(db).rebuild_tag_aggregates()
+    return aggregates(db)
+
+
+def tag(db: Database, tag_id: str, media_id: str) -> None:
+    db["tags"].upsert({"id": tag_id, "name": tag_id, "url": ""}, pk="id")
+    db["tag_mappings"].insert({"id": f"{tag_id}-{media_id}", "tag_id": tag_id, "media_id": media_id})
+
+
+def test_triggers_match_rebuild(db: Database) -> None:
+    tag(db, "rock", "artist")
+    db["scrobbles"].insert_all(
+        [
+            scrobble("2023-05-01T00:00:00"),
+            scrobble("2023-05-02T00:00:00", track_id="other"),
+            scrobble("2023-06-01T00:00:00", user="friend"),
+        ],
+        hash_id="id",
+    )
+    # Mapped after the scrobbles, on the track, the album and an entity nobody played.
+    tag(db, "indie", "track")
+    tag(db, "shoegaze", "album")
+    tag(db, "jazz", "nobody")
+    tag(db, "rock", "track")
+    db["scrobbles"].insert(scrobble("2023-06-02T00:00:00"), hash_id="id")
+    incremental = aggregates(db)
+    assert incremental[1] and incremental == rebuilt(db)
+
+    db["tag_mappings"].delete("indie-track")
+    db.execute("delete from scrobbles where timestamp = '2023-05-02T00:00:00'")
+    db.conn.commit()
+    incremental = aggregates(db)
+    assert incremental == rebuilt(db)
+    # Rock is on both the artist and the track, so the remaining play counts twice.
+    assert DataLayer(db).top_tags("user", "2023-05") == [("rock", 2), ("shoegaze", 1)]
+
+
+def test_compact_keeps_aggregates_consistent(db: Database) -> None:
+    db["artists"].insert({"id": "artist", "name": "artist", "url": ""})
+    db["albums"].insert({"id": "album", "name": "album", "url": "", "artist_id": "artist"})
+    db["tracks"].insert({"id": "track", "name": "track", "url": "", "artist_id": "artist"})
+    tag(db, "rock", "artist")
+    tag(db, "indie", "gone")  # Orphan mapping, and then orphan tag.
+    rows = [scrobble("2023-05-01T00:00:00"), scrobble("2023-05-02T00:00:00", track_id="gone")]
+    db["scrobbles"].insert_all(rows, hash_id="id")
+    # Same scrobble, from before the `user` column existed.
+    db["scrobbles"].insert(dict(rows[0], user=""), hash_id="id")
+
+    deleted = Datastore(db).compact()
+    assert deleted["scrobbles"] == 2
+    assert deleted["tag_mappings"] == 1
+    assert deleted["tags"] == 1
+    assert db["scrobbles"].count == 1
+    incremental = aggregates(db)
+    assert incremental == rebuilt(db)
+    assert DataLayer(db).top_tags("user", "2023-05") == [("rock", 1)]